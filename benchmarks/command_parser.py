@@ -0,0 +1,48 @@
+"""
+Measure how many messages per second `CommandParser` can classify: python -m benchmarks.command_parser
+"""
+
+import sys
+import timeit
+
+from elram.conversations.command_parser import CommandParser
+from elram.repository.services import CommandException
+
+MESSAGES = (
+    'Juan vino',
+    'no viene pedro',
+    'organiza Pepe',
+    'juan gastó 1500.50 en carne',
+    'pedro pagó 300 a juan',
+    'el fondo pagó 200 a juan',
+    'próxima peña',
+    'peña anterior',
+    'ver peña 120',
+    'peña actual',
+    'hola que tal',
+)
+
+
+def parse_all(parser):
+    for message in MESSAGES:
+        try:
+            parser(message)
+        except CommandException:
+            pass
+
+
+def main(number=20000):
+    duplicated = CommandParser.find_duplicated_patterns()
+    if duplicated:
+        print(f'Duplicated patterns: {duplicated}')
+        return 1
+
+    parser = CommandParser()
+    elapsed = timeit.timeit(lambda: parse_all(parser), number=number)
+    messages = number * len(MESSAGES)
+    print(f'{messages} messages in {elapsed:.3f}s: {messages / elapsed:.0f} messages/s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""Synthetic peña histories to run the benchmarks against."""
+
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from elram.config import load_config
+from elram.repository.models import Account, Attendance, Balance, Event, Transaction, User, database
+from elram.repository.services import AccountabilityService, TenantService
+
+CONFIG = load_config()
+
+
+def _create_users(tenant, users):
+    User.insert_many(
+        [
+            {
+                'tenant': tenant.id,
+                'nickname': f'User{i}',
+                'first_name': f'User{i}',
+                'last_name': f'{i:05d}',
+                'is_staff': i == 0,
+                'is_host': True,
+            }
+            for i in range(users)
+        ]
+    ).execute()
+    return User.get_hidden_host(tenant), list(User.get_hosts(tenant))
+
+
+def _create_event(rng, tenant, code, event_datetime, host, hidden_host, hosts, attendees, transactions):
+    event = Event.create(tenant=tenant, code=code, datetime=event_datetime)
+    guests = [h for h in rng.sample(hosts, min(attendees, len(hosts))) if h != host][:attendees - 1]
+    Attendance.insert_many(
+        [{'event': event.id, 'attendee': host.id, 'is_host': True}]
+        + [{'event': event.id, 'attendee': guest.id} for guest in guests]
+        + [{'event': event.id, 'attendee': hidden_host.id}]
+    ).execute()
+
+    expense, refund = Account.get_by_name(tenant.id, 'Expenses'), Account.get_by_name(tenant.id, 'Refunds')
+    attendances = list(Attendance.select(Attendance.id, Attendance.attendee).where(Attendance.event == event))
+    hidden_attendance = next(a for a in attendances if a.attendee_id == hidden_host.id)
+    rows = []
+    for attendance in attendances:
+        rows += AccountabilityService.social_fee_transactions(tenant.id, attendance.id, code)
+        if attendance is hidden_attendance:
+            continue
+        for i in range(transactions):
+            # Attendees alternate between buying things for the peña and paying their fee to the fund
+            account = expense if i % 2 == 0 else refund
+            amount = Decimal(rng.randrange(100, 5000))
+            row = {'tenant': tenant.id, 'account': account.id}
+            rows.append({**row, 'attendance': attendance.id, 'credit': amount})
+            rows.append({**row, 'attendance': hidden_attendance.id, 'debit': amount})
+    Transaction.insert_many(rows).execute()
+    Balance.rebuild(Transaction.attendance.in_([attendance.id for attendance in attendances]))
+    AccountabilityService(event).refresh_social_fees()
+    return event
+
+
+def generate(users=30, events=50, attendees=15, transactions=2, future_events=4, seed=0, tenant_name='default'):
+    """
+    Fill an empty database, or add a new tenant to it, with `users` hosts and `events` weekly peñas, the last
+    `future_events` of them still to come.
+
+    Every peña gets `attendees` attendees including its host, and each attendee makes `transactions` expenses and
+    payments. Returns the created events.
+    """
+    rng = random.Random(seed)
+    with database.atomic():
+        tenant = TenantService().create_tenant(tenant_name, password='', event_weekday=CONFIG['EVENT_WEEKDAY'])
+        hidden_host, hosts = _create_users(tenant, users)
+        first_datetime = datetime.now() - timedelta(weeks=events - future_events)
+        return [
+            _create_event(
+                rng,
+                tenant,
+                code=code,
+                event_datetime=first_datetime + timedelta(weeks=code),
+                host=hosts[code % len(hosts)],
+                hidden_host=hidden_host,
+                hosts=hosts,
+                attendees=attendees,
+                transactions=transactions,
+            )
+            for code in range(1, events + 1)
+        ]
@@ -4,6 +4,8 @@ from telegram import Update
 from telegram.ext import CallbackContext, ConversationHandler, Updater
 
 from elram.conversations.main import MainConversation
+from elram.conversations.outbox import Outbox
+from elram.metrics import start_metrics_server
 
 logger = logging.getLogger("main")
 
@@ -17,17 +19,57 @@ def error(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 
-def main(bot_key):
-    updater = Updater(bot_key, use_context=True)
+def main(bot_key, webhook=None, metrics_port=None, persistence=None):
+    """
+    Run the bot with long polling, or serving updates on an embedded HTTP server if `webhook` settings are given.
+
+    `webhook` takes the `webhook_url`, `listen`, `port`, `url_path` and `max_connections` settings. The
+    `url_path` is a secret and defaults to the bot token, so only Telegram knows where to post the updates.
+    Metrics are served on localhost at `metrics_port`, if given. Conversations are restored from `persistence`, if
+    given, so chats resume where they were after a restart.
+    """
+    updater = Updater(bot_key, use_context=True, persistence=persistence)
     dispatcher = updater.dispatcher
 
-    dispatcher.add_handler(MainConversation().get_handler())
+    outbox = Outbox()
+    outbox.start()
+    conversation_handler = MainConversation(outbox).get_handler(
+        persistent=persistence is not None
+    )
+    dispatcher.add_handler(conversation_handler)
     dispatcher.add_error_handler(error)
 
+    if metrics_port:
+        start_metrics_server(
+            metrics_port,
+            dispatcher=dispatcher,
+            conversation_handler=conversation_handler,
+        )
+
     # Start the Bot
-    updater.start_polling()
+    if webhook is None:
+        updater.start_polling()
+    else:
+        url_path = webhook["url_path"] or bot_key
+        updater.start_webhook(
+            listen=webhook["listen"],
+            port=webhook["port"],
+            url_path=url_path,
+            webhook_url=f"{webhook['webhook_url'].rstrip('/')}/{url_path}",
+            max_connections=webhook["max_connections"],
+        )
+        logger.info(
+            "Serving updates with webhook",
+            extra={
+                "listen": webhook["listen"],
+                "port": webhook["port"],
+                "url": webhook["webhook_url"],
+            },
+        )
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
+    # start_polling() and start_webhook() are non-blocking and will stop the bot
+    # gracefully.
     updater.idle()
+    outbox.stop()
@@ -3,8 +3,8 @@ import click
 from elram.config import load_config
 from elram.logger import setup_logger
 import logging
-from .commands import run_bot, bootstrap, create_next_events
-from elram.repository.commands import init_db
+from .commands import run_bot, bootstrap, create_next_events, migrate, reconcile_balances_command, member_balance, \
+    close_events, create_tenant
 
 CONFIG = load_config()
 log = logging.getLogger('main')
@@ -13,11 +13,15 @@ log = logging.getLogger('main')
 @click.group(name='elram')
 def main():
     """El Ram CLI"""
-    init_db(**CONFIG['DB'])
-    setup_logger()
+    setup_logger(CONFIG['LOG_LEVEL'], CONFIG['LOG_FORMAT'])
     log.info("Init the main application")
 
 
 main.add_command(run_bot)
 main.add_command(bootstrap)
 main.add_command(create_next_events)
+main.add_command(migrate)
+main.add_command(reconcile_balances_command)
+main.add_command(member_balance)
+main.add_command(close_events)
+main.add_command(create_tenant)
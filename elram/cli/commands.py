@@ -1,35 +1,229 @@
+import functools
 import logging
-from pathlib import Path
 
 import click
 
-from elram import bot
 from elram.config import load_config
-from elram.repository.commands import populate_db
-from elram.repository.models import Event
-from elram.repository.services import EventService
+from elram.repository.commands import (
+    OutdatedSchema, init_db, migrate_db, open_bootstrap_source, populate_db, reconcile_balances,
+)
+from elram.repository.models import Account, Event, Tenant, User
+from elram.repository.services import CommandException, EventService, TenantService, UsersService
 
 log = logging.getLogger('main')
 CONFIG = load_config()
 
 
+def with_database(command=None, check_schema=True):
+    """
+    Connect to the database right before running the command, so the CLI only connects for commands that need it.
+
+    Commands refuse to run on databases with pending migrations, unless `check_schema` is false.
+    """
+    if command is None:
+        return functools.partial(with_database, check_schema=check_schema)
+
+    @functools.wraps(command)
+    def wrapper(*args, **kwargs):
+        try:
+            init_db(**CONFIG['DB'], check_schema=check_schema)
+        except OutdatedSchema as ex:
+            raise click.ClickException(str(ex))
+        return command(*args, **kwargs)
+    return wrapper
+
+
+tenant_option = click.option(
+    '--tenant',
+    'tenant_name',
+    default=Tenant.DEFAULT_NAME,
+    help='Name of the peña group.',
+)
+
+
+def get_tenant(name):
+    try:
+        return TenantService().get_tenant(name)
+    except CommandException as ex:
+        raise click.ClickException(str(ex))
+
+
 @click.command()
 @click.argument('bot_token', type=str, default=CONFIG['BOT_TOKEN'])
-def run_bot(bot_token):
-    bot.main(bot_token)
+@click.option('--webhook', is_flag=True, help='Serve updates with a webhook instead of long polling.')
+@click.option('--webhook-url', default=CONFIG['WEBHOOK']['webhook_url'], help='Public URL of the webhook server.')
+@click.option('--listen', default=CONFIG['WEBHOOK']['listen'], help='Address the webhook server listens on.')
+@click.option('--port', type=int, default=CONFIG['WEBHOOK']['port'], help='Port the webhook server listens on.')
+@click.option('--url-path', default=CONFIG['WEBHOOK']['url_path'], help='Secret path of the webhook.')
+@click.option(
+    '--max-connections',
+    type=int,
+    default=CONFIG['WEBHOOK']['max_connections'],
+    help='Max concurrent connections Telegram opens to the webhook.',
+)
+@click.option(
+    '--metrics-port',
+    type=int,
+    default=CONFIG['METRICS_PORT'],
+    help='Local port of the Prometheus metrics endpoint, 0 to disable it.',
+)
+@click.option(
+    '--persistence',
+    type=click.Choice(['file', 'sqlite', 'none']),
+    default=CONFIG['PERSISTENCE']['backend'] or 'none',
+    help='Where the conversations are kept to resume them after a restart.',
+)
+@click.option('--persistence-file', default=CONFIG['PERSISTENCE']['filename'], help='File of the conversations.')
+@with_database
+def run_bot(
+    bot_token,
+    webhook,
+    webhook_url,
+    listen,
+    port,
+    url_path,
+    max_connections,
+    metrics_port,
+    persistence,
+    persistence_file,
+):
+    # Importing the Telegram library takes most of the CLI startup, so only the bot pays for it
+    from elram import bot
+    from elram.conversations.persistence import get_persistence
+
+    if webhook and not webhook_url:
+        raise click.UsageError('--webhook-url is required to serve updates with a webhook')
+    webhook_settings = None
+    if webhook:
+        webhook_settings = {
+            'webhook_url': webhook_url,
+            'listen': listen,
+            'port': port,
+            'url_path': url_path,
+            'max_connections': max_connections,
+        }
+    bot.main(
+        bot_token,
+        webhook=webhook_settings,
+        metrics_port=metrics_port,
+        persistence=get_persistence(persistence if persistence != 'none' else None, persistence_file),
+    )
 
 
 @click.command()
-@click.argument('bootstrap_file_url', default=CONFIG['BOOTSTRAP_FILE_URL'])
-def bootstrap(bootstrap_file_url):
-    service = EventService()
-    bootstrap_data = service.get_bootstrap_data(bootstrap_file_url)
-    populate_db(bootstrap_data)
+@click.argument('source', default=CONFIG['BOOTSTRAP_FILE_URL'])
+@click.option('--batch-size', type=int, default=CONFIG['BOOTSTRAP_BATCH_SIZE'], help='Records inserted per query.')
+@tenant_option
+@with_database
+def bootstrap(source, batch_size, tenant_name):
+    """Load the bootstrap document from a local path or an URL."""
+    # The default tenant is created from the settings, so a single group can still be bootstrapped from scratch
+    tenant = Tenant.get_default() if tenant_name == Tenant.DEFAULT_NAME else get_tenant(tenant_name)
+    # Transactions and attendances refer to the accounts and users of the document by id, so it must own all of them
+    if Account.select().where(Account.tenant == tenant).exists() or User.select().where(User.tenant == tenant).exists():
+        raise click.ClickException(
+            f'Tenant {tenant.name} already has accounts or users, create it with `elram create-tenant --bootstrap`'
+        )
+    service = EventService(tenant)
+    with open_bootstrap_source(source) as stream:
+        populate_db(stream, tenant, batch_size=batch_size)
     service.create_first_event()
     service.create_future_events()
 
 
 @click.command()
-def create_next_events():
-    service = EventService()
-    service.create_future_events()
+@click.option('--tenant', 'tenant_name', help='Name of the peña group, all of them by default.')
+@with_database
+def create_next_events(tenant_name):
+    tenants = [get_tenant(tenant_name)] if tenant_name else list(Tenant.select())
+    failed = []
+    for tenant in tenants:
+        service = EventService(tenant)
+        try:
+            if Event.get_last_event(tenant) is None:
+                if not tenant.first_event_host_nickname:
+                    log.warning('Tenant without first host, skipping it', extra={'tenant': tenant.name})
+                    continue
+                service.create_first_event()
+            service.create_future_events()
+        except Exception:
+            # One misconfigured group doesn't keep the others without events
+            log.exception('Error creating the events', extra={'tenant': tenant.name})
+            failed.append(tenant.name)
+    if failed:
+        raise click.ClickException(f'Could not create the events of {", ".join(failed)}')
+
+
+@click.command(name='create-tenant')
+@click.argument('name')
+@click.option('--password', required=True, help='Password the staff members sign up with.')
+@click.option('--weekday', type=click.IntRange(0, 6), required=True, help='Weekday of the events, 0 is Monday.')
+@click.option('--chat-id', type=int, help='Telegram chat of the group.')
+@click.option('--first-event-code', type=int, default=1, help='Code of the first event.')
+@click.option('--first-host', help='Nickname of the host of the first event.')
+@click.option('--bootstrap', is_flag=True, help='Leave the accounts and users to `elram bootstrap`.')
+@with_database
+def create_tenant(name, password, weekday, chat_id, first_event_code, first_host, bootstrap):
+    """Register a new peña group."""
+    tenant = TenantService().create_tenant(
+        name,
+        password=password,
+        event_weekday=weekday,
+        chat_id=chat_id,
+        first_event_code=first_event_code,
+        first_event_host_nickname=first_host,
+        with_records=not bootstrap,
+    )
+    click.echo(f'Created tenant {tenant.name}')
+
+
+@click.command()
+@with_database(check_schema=False)
+def migrate():
+    """Apply the pending migrations to the database schema."""
+    applied = migrate_db()
+    click.echo(f'Applied migrations: {applied}' if applied else 'Database schema is up to date')
+
+
+@click.command(name='reconcile-balances')
+@click.option('--fix', is_flag=True, help='Rebuild the balances from the transactions if they differ.')
+@with_database
+def reconcile_balances_command(fix):
+    """Check the balances against the transactions."""
+    mismatches = reconcile_balances(fix=fix)
+    if not mismatches:
+        click.echo('Balances match the transactions')
+    else:
+        click.echo(f'{len(mismatches)} balances differ from the transactions{", rebuilt" if fix else ""}')
+
+
+@click.command()
+@click.argument('nickname')
+@tenant_option
+@with_database
+def member_balance(nickname, tenant_name):
+    """Show how much a member owes across all the events."""
+    try:
+        user, total, accounts = UsersService(get_tenant(tenant_name)).get_member_balance(nickname)
+    except CommandException as ex:
+        raise click.ClickException(str(ex))
+    click.echo(f'{user.nickname}: {round(total, 2)}')
+    for account, balance in accounts:
+        click.echo(f'  {account.name}: {round(balance, 2)}')
+
+
+@click.command(name='close-events')
+@click.argument('codes', nargs=-1, type=int)
+@click.option('--past', is_flag=True, help='Close all the events that already happened.')
+@tenant_option
+@with_database
+def close_events(codes, past, tenant_name):
+    """Close the events, freezing their financial status."""
+    service = EventService(get_tenant(tenant_name))
+    try:
+        events = list(service.get_closable_events()) if past else [service.find_event_by_code(c) for c in codes]
+        for event in events:
+            service.close_event(event)
+            click.echo(f'Closed event {event.code}')
+    except CommandException as ex:
+        raise click.ClickException(str(ex))
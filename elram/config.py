@@ -1,16 +1,29 @@
 import os
+from functools import lru_cache
 from urllib.parse import urlparse
 
 
-def clean_setting(key):
-    return os.environ[key].replace("\n", "").replace("\r", "")
+def clean_setting(key, default=None):
+    value = os.environ[key] if default is None else os.environ.get(key, default)
+    return value.replace("\n", "").replace("\r", "")
 
 
+@lru_cache(maxsize=None)
 def load_config():
+    """
+    Settings read from the environment. Parsed on the first call only, every module shares the same settings.
+    """
     params = urlparse(os.environ["DATABASE_URL"])
     config = {
         "PASSWORD": clean_setting("PASSWORD"),
         "BOT_TOKEN": clean_setting("BOT_TOKEN"),
+        "WEBHOOK": {
+            "webhook_url": clean_setting("WEBHOOK_URL", ""),
+            "listen": clean_setting("WEBHOOK_LISTEN", "0.0.0.0"),
+            "port": int(clean_setting("PORT", "8443")),
+            "url_path": clean_setting("WEBHOOK_SECRET", ""),
+            "max_connections": int(clean_setting("WEBHOOK_MAX_CONNECTIONS", "40")),
+        },
         "EVENT_WEEKDAY": int(clean_setting("EVENT_WEEKDAY")),
         "DATETIME_FORMATS": [
             "%d/%m/%Y",
@@ -29,8 +42,20 @@ def load_config():
             "password": params.password,
             "host": params.hostname,
             "port": params.port,
+            "max_connections": int(clean_setting("DB_MAX_CONNECTIONS", "8")),
+            "stale_timeout": int(clean_setting("DB_STALE_TIMEOUT", "300")),
+            "health_check": clean_setting("DB_HEALTH_CHECK", "1") == "1",
+        },
+        "SLOW_QUERY_MS": float(clean_setting("SLOW_QUERY_MS", "100")),
+        "LOG_LEVEL": clean_setting("LOG_LEVEL", "info"),
+        "METRICS_PORT": int(clean_setting("METRICS_PORT", "9100")),
+        "PERSISTENCE": {
+            "backend": clean_setting("PERSISTENCE_BACKEND", ""),
+            "filename": clean_setting("PERSISTENCE_FILE", "conversations.db"),
         },
+        "LOG_FORMAT": clean_setting("LOG_FORMAT", "text"),
         "BOOTSTRAP_FILE_URL": clean_setting("BOOTSTRAP_FILE_URL"),
+        "BOOTSTRAP_BATCH_SIZE": int(clean_setting("BOOTSTRAP_BATCH_SIZE", "1000")),
         "FIRST_EVENT_CODE": int(clean_setting("FIRST_EVENT_CODE")),
         "FIRST_EVENT_HOST_NICKNAME": clean_setting("FIRST_EVENT_HOST_NICKNAME"),
         "HIDDEN_USER_NICKNAME": clean_setting("HIDDEN_USER_NICKNAME"),
@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 
 from elram.repository.services import CommandException
 
@@ -68,31 +69,139 @@ class CommandParser:
             r'^quiero ver la pena (?P<event_code>\d+)$',
             r'^ver pena (?P<event_code>\d+)$',
         ),
+        'member_balance': (
+            r'^cuanto debe (?P<nickname>\w+)$',
+            r'^cuánto debe (?P<nickname>\w+)$',
+            r'^saldo de (?P<nickname>\w+)$',
+        ),
+        'close_event': (
+            r'^cerrar la peña$',
+            r'^cerrar peña$',
+            r'^cerrar la pena$',
+            r'^cerrar pena$',
+        ),
         'active_event': (
-            r'proxima peña$',
-            r'próxima peña$',
-            r'proxima pena$',
-            r'próxima pena$',
+            r'peña actual$',
+            r'pena actual$',
         )
     }
 
+    # Values of the named groups in the sample messages built to check the patterns
+    _sample_values = {
+        'nickname': 'juan',
+        'to_nickname': 'pedro',
+        'amount': '10',
+        'description': 'pan',
+        'event_code': '1',
+    }
+
+    def __init__(self):
+        self._grammar, self._alternatives = self._compile_grammar()
+
+    @classmethod
+    def find_duplicated_patterns(cls):
+        """
+        Return the `(command, pattern, shadowed_by)` tuples of every pattern that is shadowed by a previous one,
+        either a copy of it or a more general one, and hence can never be matched.
+
+        Each pattern is checked with a sample message built from it, which must be parsed by that same pattern.
+        """
+        grammar, alternatives = cls._build_grammar()
+        patterns = [(command, pattern) for command, patterns in cls._commands_mapping.items() for pattern in patterns]
+        duplicated = []
+        for name, (command, pattern) in zip(alternatives, patterns):
+            match = grammar.match(cls._sample_message(pattern))
+            if match is None or match.lastgroup != name:
+                shadowed_by = alternatives[match.lastgroup][0] if match is not None else None
+                duplicated.append((command, pattern, shadowed_by))
+        return duplicated
+
+    @classmethod
+    def _sample_message(cls, pattern):
+        """
+        Build a message matched by `pattern`, replacing its named groups with sample values.
+        """
+        sample = pattern
+        while True:
+            start = sample.find('(?P<')
+            if start == -1:
+                break
+            name = sample[start + 4:sample.index('>', start)]
+            # Skip to the parenthesis closing the group
+            depth = 0
+            for end in range(start, len(sample)):
+                if sample[end] == '(':
+                    depth += 1
+                elif sample[end] == ')':
+                    depth -= 1
+                    if depth == 0:
+                        break
+            sample = sample[:start] + cls._sample_values[name] + sample[end + 1:]
+        return sample.strip('^$')
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def _compile_grammar(cls):
+        """
+        Compile the grammar once for all the parsers, failing if any pattern is shadowed by a previous one.
+        """
+        duplicated = cls.find_duplicated_patterns()
+        if duplicated:
+            raise ValueError(f'Duplicated command patterns: {duplicated}')
+        return cls._build_grammar()
+
+    @classmethod
+    def _build_grammar(cls):
+        """
+        Build a single regex with one named alternative per pattern.
+
+        Named groups are prefixed with the alternative name since a regex can't repeat group names. Patterns that are
+        not anchored to the start of the message are prefixed with `.*?`, so the alternatives keep the same priority
+        than the order they are declared in.
+        """
+        regexes = []
+        alternatives = {}
+        for command, patterns in cls._commands_mapping.items():
+            for pattern in patterns:
+                name = f'p{len(regexes)}'
+                groups = {}
+
+                def rename_group(match):
+                    group = f'{name}_{match.group(1)}'
+                    groups[group] = match.group(1)
+                    return f'(?P<{group}>'
+
+                pattern = re.sub(r'\(\?P<(\w+)>', rename_group, pattern)
+                if not pattern.startswith('^'):
+                    pattern = f'^.*?{pattern}'
+                regexes.append(f'(?P<{name}>{pattern})')
+                alternatives[name] = (command, groups)
+        return re.compile('|'.join(regexes)), alternatives
+
     def __call__(self, message):
         message = self._clean_message(message)
-        for command in self._commands_mapping.keys():
-            result = self._is_command(command, message)
-            if result is not None:
-                return result
-        raise CommandException('mmmm no entendí')
+        match = self._grammar.match(message)
+        if match is None:
+            raise CommandException('mmmm no entendí')
+        command, groups = self._alternatives[match.lastgroup]
+        kwargs = {key: match.group(group) for group, key in groups.items()}
+        return command, kwargs
+
+    def parse_batch(self, message):
+        """
+        Parse every non empty line of the message as a command. Fails if any line is not understood.
+        """
+        lines = [line for line in message.splitlines() if line.strip()]
+        if len(lines) <= 1:
+            return [self(message)]
+        commands = []
+        for number, line in enumerate(lines, 1):
+            try:
+                commands.append(self(line))
+            except CommandException:
+                raise CommandException(f'mmmm no entendí la línea {number}: {line.strip()}')
+        return commands
 
     @staticmethod
     def _clean_message(message):
         return message.lower().strip()
-
-    def _is_command(self, command, message):
-        for patter in self._commands_mapping[command]:
-            regex = re.compile(patter)
-            match = regex.search(message)
-            if not match:
-                continue
-            kwargs = {key: match.group(key) for key in regex.groupindex.keys()}
-            return command, kwargs
@@ -1,10 +1,15 @@
 import logging
-import time
+import threading
+from collections import defaultdict
+from contextlib import nullcontext
 
-from telegram import Update, Chat
+from telegram import Update
 from telegram.ext import CallbackContext, ConversationHandler, CommandHandler, Filters, MessageHandler
 from elram.conversations.command_parser import CommandParser
-from elram.repository.models import Event
+from elram.conversations.outbox import Outbox
+from elram.metrics import COMMAND_SECONDS, observe_telegram
+from elram.profiling import get_profile, profile_command
+from elram.repository.models import Event, Tenant, database
 from elram.repository.services import EventService, AttendanceService, CommandException, UsersService, \
     AccountabilityService
 
@@ -12,43 +17,111 @@ logger = logging.getLogger('main')
 
 
 class MainConversation:
-    _event_service = EventService()
-    _users_service = UsersService()
-    _command_parser = CommandParser()
-    _attendance_service = None
-    _accountability_service = None
+    """
+    Conversation with the staff members, where each message is a command for the event they are looking at.
 
+    Handlers run in parallel worker threads and the handler object is shared by all the conversations, so it only
+    holds stateless services. The tenant of each chat and the event each member of the chat is looking at are kept in
+    its `chat_data`, and the services that act on them are built for every update.
+
+    Only ids are kept in the conversation data, so it can be persisted and resumed after a restart.
+    """
     LOGIN, LISTENING = range(2)
+    # Seconds the command and its reply stay in the chat before being deleted
+    CLEANUP_DELAY = 2
+    NAVIGATION_COMMANDS = ('next_event', 'previous_event', 'find_event', 'active_event')
+    # Commands that can't be batched with others, since they change the event the rest of the commands apply to
+    STANDALONE_COMMANDS = NAVIGATION_COMMANDS + ('close_event',)
+
+    def __init__(self, outbox: Outbox):
+        self._outbox = outbox
+        # Event services by tenant id, shared so they share their render cache
+        self._event_services = {}
+        self._command_parser = CommandParser()
+        # Messages of the same user are handled one at a time, so they don't race on the event they are looking at.
+        # Messages of different users on the same event are serialized by locking the event in the database
+        self._user_locks = defaultdict(threading.Lock)
+        self._user_locks_lock = threading.Lock()
+
+    def _get_event_service(self, context: CallbackContext):
+        if 'tenant_id' not in context.chat_data:
+            raise CommandException('No sé de qué peña es este chat, mandá /start')
+        tenant_id = context.chat_data['tenant_id']
+        service = self._event_services.get(tenant_id)
+        if service is None:
+            service = self._event_services.setdefault(tenant_id, EventService(Tenant.get_by_id(tenant_id)))
+        return service
+
+    def _get_tenant(self, context: CallbackContext):
+        return self._get_event_service(context).tenant
 
-    def _set_main_event(self, event: Event, chat: Chat, context: CallbackContext):
-        event_message = chat.send_message(text=self._event_service.display_event(event), parse_mode='MarkdownV2')
-        context.user_data['event'] = event
-        context.user_data['emsg'] = event_message
-        self._refresh_services(event)
+    @staticmethod
+    def _get_view(update: Update, context: CallbackContext):
+        """
+        Get what the member that sent the update is looking at in its chat: its user, the event and its message.
+        """
+        # Keys are strings, since the persistence stores them as JSON
+        return context.chat_data.setdefault('views', {}).setdefault(str(update.effective_user.id), {})
 
-    def _refresh_services(self, event):
-        self._attendance_service = AttendanceService(event)
-        self._accountability_service = AccountabilityService(event)
+    def _get_event(self, update: Update, context: CallbackContext):
+        view = self._get_view(update, context)
+        if 'event_id' not in view:
+            raise CommandException('No sé qué peña estás mirando, mandá /start')
+        event = Event.get_by_id(view['event_id'])
+        if event.tenant_id != context.chat_data.get('tenant_id'):
+            raise CommandException('Esa peña es de otro grupo, mandá /start')
+        return event
 
-    def _refresh_main_event(self, context: CallbackContext):
-        event = context.user_data['event'].refresh()
-        new_msg_text = self._event_service.display_event(event)
-        if new_msg_text != context.user_data['emsg'].text:
-            context.user_data['emsg'].edit_text(new_msg_text, parse_mode='MarkdownV2')
+    def _set_main_event(self, event: Event, update: Update, context: CallbackContext):
+        text = self._get_event_service(context).display_event(event)
+        profile = get_profile()
+        with profile.telegram() if profile is not None else nullcontext(), observe_telegram('sendMessage'):
+            event_message = update.effective_chat.send_message(text=text, parse_mode='MarkdownV2')
+        self._outbox.record_text(event_message.chat_id, event_message.message_id, text)
+        view = self._get_view(update, context)
+        view['event_id'] = event.id
+        view['message_id'] = event_message.message_id
+
+    def _user_lock(self, user_id):
+        with self._user_locks_lock:
+            return self._user_locks[user_id]
+
+    @staticmethod
+    def _get_services(event: Event):
+        # Users are looked up in the tenant of the event, so commands can never mix the data of two groups
+        accountability_service = AccountabilityService(event)
+        return AttendanceService(event, accountability_service=accountability_service), accountability_service
+
+    def _refresh_main_event(self, update: Update, context: CallbackContext):
+        event = self._get_event(update, context)
+        new_msg_text = self._get_event_service(context).display_event(event)
+        self._outbox.edit_text(
+            context.bot,
+            update.effective_chat.id,
+            self._get_view(update, context)['message_id'],
+            new_msg_text,
+            parse_mode='MarkdownV2',
+        )
 
     def _wrong_command(self, message):
-        return message.reply_text("mmm... no te entendí.")
+        self._outbox.reply_text(message, "mmm... no te entendí.", delete_after=self.CLEANUP_DELAY)
 
+    @database.connection_context()
     def main(self, update: Update, context: CallbackContext):
         telegram_user = update.message.from_user
-        user = self._users_service.sign_in(telegram_user)
+        tenant = Tenant.get_for_chat(update.effective_chat.id)
+        if tenant is None:
+            update.message.reply_text('Este chat no es de ninguna peña.')
+            return ConversationHandler.END
+        context.chat_data['tenant_id'] = tenant.id
+        user = UsersService(tenant).sign_in(telegram_user)
         if user:
-            context.user_data['user'] = user
+            self._get_view(update, context)['user_id'] = user.id
             update.message.reply_text(
                 f'Que haces {user.first_name}?'
             )
-            event = self._event_service.get_active_event()
-            self._set_main_event(event, update.effective_chat, context)
+            event = self._get_event_service(context).get_active_event()
+            self._set_main_event(event, update, context)
             return self.LISTENING
         else:
             update.message.reply_text(
@@ -56,14 +129,17 @@ class MainConversation:
             )
             return self.LOGIN
 
+    @database.connection_context()
     def login(self, update: Update, context: CallbackContext):
         telegram_user = update.message.from_user
         password = update.message.text
-        user = self._users_service.sign_up(telegram_user, password)
+        tenant = self._get_tenant(context)
+        user = UsersService(tenant).sign_up(telegram_user, password)
         if user is None:
             logger.warning(
                 'Wrong password',
                 extra={
+                    'tenant': tenant.name,
                     'telegram_id': telegram_user.id,
                     'username': telegram_user.username,
                 }
@@ -73,64 +149,98 @@ class MainConversation:
             )
             return self.LOGIN
         else:
-            context.user_data['user'] = user
+            self._get_view(update, context)['user_id'] = user.id
             update.message.reply_text(
                 f'A si, de una. Vos sos {user.first_name}'
             )
-            self._set_main_event(update.effective_chat, context)
+            event = self._get_event_service(context).get_active_event()
+            self._set_main_event(event, update, context)
             return self.LISTENING
 
+    def _execute_command(
+        self,
+        command,
+        kwargs,
+        attendance_service: AttendanceService,
+        accountability_service: AccountabilityService,
+        update: Update,
+        context: CallbackContext,
+    ):
+        logger.info("Attempt to execute command", extra={'command': command, 'kwargs': kwargs})
+        if command == 'add_attendee':
+            attendance_service.add_attendance(**kwargs)
+        elif command == 'remove_attendee':
+            attendance_service.remove_attendance(**kwargs)
+        elif command == 'replace_host':
+            attendance_service.replace_host(**kwargs)
+        elif command == 'add_expense':
+            accountability_service.add_expense(**kwargs)
+        elif command == 'add_payment':
+            accountability_service.add_payment(**kwargs)
+        elif command == 'add_refund':
+            accountability_service.add_refound(**kwargs)
+        elif command == 'next_event':
+            event = self._get_event_service(context).find_event_by_code(
+                event_code=accountability_service.event.code + 1,
+            )
+            self._set_main_event(event, update, context)
+        elif command == 'previous_event':
+            event = self._get_event_service(context).find_event_by_code(
+                event_code=accountability_service.event.code - 1,
+            )
+            self._set_main_event(event, update, context)
+        elif command == 'find_event':
+            event = self._get_event_service(context).find_event_by_code(**kwargs)
+            self._set_main_event(event, update, context)
+        elif command == 'close_event':
+            self._get_event_service(context).close_event(accountability_service.event)
+        elif command == 'member_balance':
+            self._outbox.reply_text(
+                update.message,
+                UsersService(self._get_tenant(context)).display_member_balance(**kwargs),
+                parse_mode='MarkdownV2',
+            )
+        elif command == 'active_event':
+            event = self._get_event_service(context).get_active_event()
+            self._set_main_event(event, update, context)
+        else:
+            self._wrong_command(update.message)
+
+    @database.connection_context()
     def listen(self, update: Update, context: CallbackContext):
         message = update.message
-        to_delete = [message]
-
-        try:
-            command, kwargs = self._command_parser(message.text)
-            logger.info("Attempt to execute command", extra={'command': command, 'kwargs': kwargs})
-            if command == 'add_attendee':
-                self._attendance_service.add_attendance(**kwargs)
-            elif command == 'remove_attendee':
-                self._attendance_service.remove_attendance(**kwargs)
-            elif command == 'replace_host':
-                self._attendance_service.replace_host(**kwargs)
-            elif command == 'add_expense':
-                self._accountability_service.add_expense(**kwargs)
-            elif command == 'add_payment':
-                self._accountability_service.add_payment(**kwargs)
-            elif command == 'add_refund':
-                self._accountability_service.add_refound(**kwargs)
-            elif command == 'next_event':
-                event = self._event_service.find_event_by_code(
-                    event_code=context.user_data['event'].code + 1,
-                )
-                self._set_main_event(event, update.effective_chat, context)
-            elif command == 'previous_event':
-                event = self._event_service.find_event_by_code(
-                    event_code=context.user_data['event'].code - 1,
-                )
-                self._set_main_event(event, update.effective_chat, context)
-            elif command == 'find_event':
-                event = self._event_service.find_event_by_code(**kwargs)
-                self._set_main_event(event, update.effective_chat, context)
-            elif command == 'active_event':
-                event = self._event_service.get_active_event()
-                self._set_main_event(event, update.effective_chat, context)
-            else:
-                reply_message = self._wrong_command(message)
-                to_delete.append(reply_message)
-            self._refresh_main_event(context)
-        except CommandException as ex:
-            msg = message.reply_text(str(ex))
-            to_delete.append(msg)
-        finally:
-            time.sleep(2)
-            for msg in to_delete:
-                msg.delete()
-            return self.LISTENING
 
+        with profile_command() as profile, self._user_lock(message.from_user.id):
+            try:
+                commands = self._command_parser.parse_batch(message.text)
+                profile.command = ','.join(command for command, _ in commands)
+                if len(commands) > 1 and any(command in self.STANDALONE_COMMANDS for command, _ in commands):
+                    raise CommandException('Para cambiar o cerrar la peña mandá un mensaje aparte')
+                event = self._get_event(update, context)
+                attendance_service, accountability_service = self._get_services(event)
+                # All the commands of the message are applied or none is, and the social fees are refreshed once
+                with database.atomic(), accountability_service.deferred_refresh():
+                    # Other members can be changing the same event, so it's locked before reading anything the social
+                    # fees are computed from
+                    Event.get_status(event.id, for_update=True)
+                    for command, kwargs in commands:
+                        self._execute_command(
+                            command, kwargs, attendance_service, accountability_service, update, context
+                        )
+                self._refresh_main_event(update, context)
+            except CommandException as ex:
+                self._outbox.reply_text(message, str(ex), delete_after=self.CLEANUP_DELAY)
+            finally:
+                self._outbox.delete(message, delay=self.CLEANUP_DELAY)
+                stats = profile.as_dict()
+                logger.info('Command handled', extra=stats)
+                command = 'batch' if profile.command and ',' in profile.command else profile.command or 'unknown'
+                COMMAND_SECONDS.labels(command).observe(stats['total_ms'] / 1000)
+                return self.LISTENING
+
+    @database.connection_context()
     def cancel(self, update: Update, context: CallbackContext) -> int:
-        user = context.user_data['user']
-        logger.info('Conversation canceled', extra={'telegram_id': user.telegram_id})
+        logger.info('Conversation canceled', extra={'telegram_id': update.message.from_user.id})
         update.message.reply_text(
             'Bueno, listo. Tomate el palo\n'
             'Si querés volvera hablar mandá /start'
@@ -138,14 +248,19 @@ class MainConversation:
 
         return ConversationHandler.END
 
-    def get_handler(self):
+    def get_handler(self, persistent=False):
+        """
+        Build the handler of the conversation, which is restored from the dispatcher persistence if `persistent`.
+        """
         return ConversationHandler(
             entry_points=[CommandHandler('start', self.main)],
             states={
                 self.LOGIN: [MessageHandler(Filters.text, self.login)],
                 self.LISTENING: [
-                    MessageHandler(Filters.text & (~Filters.command), self.listen)
+                    MessageHandler(Filters.text & (~Filters.command), self.listen, run_async=True)
                 ],
             },
             fallbacks=[CommandHandler('cancel', self.cancel)],
+            name='main',
+            persistent=persistent,
         )
@@ -0,0 +1,199 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+
+import attr
+from telegram import Bot, Chat, Message
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from elram.metrics import observe_telegram
+
+logger = logging.getLogger('main')
+
+
+@attr.s
+class _Operation:
+    due: float = attr.ib()
+    kind: str = attr.ib()
+    bot: Bot = attr.ib()
+    chat_id: int = attr.ib()
+    message_id: int = attr.ib()
+    text: str = attr.ib(default=None)
+    kwargs: dict = attr.ib(factory=dict)
+    delete_after: float = attr.ib(default=None)
+
+
+@attr.s
+class _ChatQueue:
+    # Seconds between two calls to the chat
+    interval: float = attr.ib()
+    operations: OrderedDict = attr.ib(factory=OrderedDict)
+    # Last text sent for each message, so edits that don't change anything are skipped
+    texts: dict = attr.ib(factory=dict)
+    next_send: float = attr.ib(default=0.0)
+
+
+@attr.s
+class Outbox:
+    """
+    Queue of outbound Telegram calls, sent from a background thread.
+
+    Handlers only enqueue edits, replies and deletions, and the outbox sends them paced within the Telegram
+    rate limits: at most one call every `chat_interval` seconds to the same private chat, one every `group_interval`
+    seconds to the same group, and at most `global_rate` calls per second overall. Pending edits of the same message
+    are coalesced into the latest one. Deletions are paced like any other call, since the Bot API has no bulk delete.
+
+    Edits refer to the message by its chat and message ids, so messages can be edited after a restart. Pending
+    operations are sent, without waiting for their delay, when the outbox is stopped.
+    """
+    chat_interval: float = attr.ib(default=1.0)
+    # Telegram allows about 20 messages per minute to a group
+    group_interval: float = attr.ib(default=3.0)
+    global_rate: float = attr.ib(default=30.0)
+    _chats: dict = attr.ib(init=False, factory=dict)
+    _condition: threading.Condition = attr.ib(init=False, factory=threading.Condition)
+    _keys = attr.ib(init=False, factory=count)
+    _last_send: float = attr.ib(init=False, default=0.0)
+    _running: bool = attr.ib(init=False, default=False)
+    _thread: threading.Thread = attr.ib(init=False, default=None)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def edit_text(self, bot: Bot, chat_id: int, message_id: int, text: str, **kwargs):
+        with self._condition:
+            chat = self._get_chat(chat_id)
+            key = ('edit', message_id)
+            if key in chat.operations:
+                # Keep the position of the pending edit, but send the latest text
+                chat.operations[key].text = text
+                chat.operations[key].kwargs = kwargs
+            elif chat.texts.get(message_id) == text:
+                return
+            else:
+                chat.operations[key] = _Operation(time.monotonic(), 'edit', bot, chat_id, message_id, text, kwargs)
+            self._condition.notify()
+
+    def record_text(self, chat_id: int, message_id: int, text: str):
+        """
+        Record the text of a message sent outside the outbox, so it isn't edited to the same text.
+        """
+        with self._condition:
+            self._get_chat(chat_id).texts[message_id] = text
+
+    def reply_text(self, message: Message, text: str, delete_after: float = None, **kwargs):
+        # Quote the message outside private chats, as `Message.reply_text` does
+        if message.chat.type != Chat.PRIVATE:
+            kwargs.setdefault('reply_to_message_id', message.message_id)
+        operation = _Operation(
+            time.monotonic(), 'reply', message.bot, message.chat_id, message.message_id, text, kwargs, delete_after
+        )
+        self._enqueue(message.chat_id, ('reply', next(self._keys)), operation)
+
+    def delete(self, message: Message, delay: float = 0):
+        operation = _Operation(time.monotonic() + delay, 'delete', message.bot, message.chat_id, message.message_id)
+        self._enqueue(message.chat_id, ('delete', message.message_id), operation)
+
+    def _enqueue(self, chat_id, key, operation):
+        with self._condition:
+            self._get_chat(chat_id).operations[key] = operation
+            self._condition.notify()
+
+    def _get_chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            # Ids of groups and channels are negative, the ones of private chats are the user ids
+            interval = self.chat_interval if chat_id > 0 else self.group_interval
+            chat = self._chats[chat_id] = _ChatQueue(interval)
+        return chat
+
+    def _next_operation(self, now, drain=False):
+        """
+        Pop the next operation to send for the first chat that can receive it, or return the seconds to wait until
+        there is one. Delayed operations are due right away if `drain` is set.
+        """
+        wait = None
+        for chat in self._chats.values():
+            due = next(((k, o) for k, o in chat.operations.items() if drain or o.due <= now), None)
+            if due is not None and chat.next_send <= now:
+                key, operation = due
+                del chat.operations[key]
+                chat.next_send = now + chat.interval
+                return operation, None
+            pending = [now if drain else o.due for o in chat.operations.values()]
+            if pending:
+                ready_at = max(min(pending), chat.next_send)
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._condition:
+                operation, wait = self._next_operation(time.monotonic(), drain=not self._running)
+                if operation is None:
+                    if wait is None and not self._running:
+                        return
+                    self._condition.wait(wait)
+                    continue
+            self._send(operation)
+
+    def _send(self, operation: _Operation):
+        elapsed = time.monotonic() - self._last_send
+        if elapsed < 1 / self.global_rate:
+            time.sleep(1 / self.global_rate - elapsed)
+        self._last_send = time.monotonic()
+        try:
+            if operation.kind == 'edit':
+                with observe_telegram('editMessageText'):
+                    operation.bot.edit_message_text(
+                        operation.text,
+                        chat_id=operation.chat_id,
+                        message_id=operation.message_id,
+                        **operation.kwargs,
+                    )
+                self._record_sent_text(operation)
+            elif operation.kind == 'reply':
+                with observe_telegram('sendMessage'):
+                    reply = operation.bot.send_message(operation.chat_id, operation.text, **operation.kwargs)
+                if operation.delete_after is not None:
+                    self.delete(reply, delay=operation.delete_after)
+            elif operation.kind == 'delete':
+                with observe_telegram('deleteMessage'):
+                    operation.bot.delete_message(operation.chat_id, operation.message_id)
+        except RetryAfter as ex:
+            logger.warning('Rate limited by Telegram', extra={'retry_after': ex.retry_after, 'kind': operation.kind})
+            with self._condition:
+                chat = self._chats[operation.chat_id]
+                chat.next_send = time.monotonic() + ex.retry_after
+                key = (operation.kind, operation.message_id if operation.kind != 'reply' else next(self._keys))
+                chat.operations.setdefault(key, operation)
+                chat.operations.move_to_end(key, last=False)
+        except BadRequest as ex:
+            if operation.kind == 'edit' and 'message is not modified' in str(ex).lower():
+                # The message already shows the text
+                self._record_sent_text(operation)
+            else:
+                self._forget_text(operation)
+                logger.warning('Outbound message failed', extra={'error': ex, 'kind': operation.kind})
+        except TelegramError as ex:
+            self._forget_text(operation)
+            logger.warning('Outbound message failed', extra={'error': ex, 'kind': operation.kind})
+
+    def _record_sent_text(self, operation: _Operation):
+        self.record_text(operation.chat_id, operation.message_id, operation.text)
+
+    def _forget_text(self, operation: _Operation):
+        if operation.kind == 'edit':
+            with self._condition:
+                self._chats[operation.chat_id].texts.pop(operation.message_id, None)
@@ -0,0 +1,118 @@
+import json
+import logging
+import sqlite3
+import threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence, PicklePersistence
+
+logger = logging.getLogger('main')
+
+
+def resolved_state(state):
+    """
+    Return the last resolved state of a conversation.
+
+    Conversations waiting for an async handler come as `(old_state, promise)`, where `old_state` can be pending too,
+    and promises can't be serialized.
+    """
+    while isinstance(state, tuple):
+        state = state[0]
+    return state
+
+
+class FilePersistence(PicklePersistence):
+    """
+    Keep the conversations and the user and chat data in a pickle file.
+    """
+
+    def update_conversation(self, name, key, new_state):
+        super().update_conversation(name, key, resolved_state(new_state))
+
+
+class SqlitePersistence(BasePersistence):
+    """
+    Keep the conversations and the user and chat data in a SQLite file, as JSON documents.
+
+    Conversations only store ids in their data, so it's always serializable and it's written on every update.
+    """
+
+    def __init__(self, filename: str, store_user_data=True, store_chat_data=True, store_bot_data=False):
+        super().__init__(
+            store_user_data=store_user_data,
+            store_chat_data=store_chat_data,
+            store_bot_data=store_bot_data,
+        )
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS state (kind TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, '
+            'PRIMARY KEY (kind, key))'
+        )
+
+    def _load(self, kind):
+        with self._lock:
+            rows = self._connection.execute('SELECT key, data FROM state WHERE kind = ?', (kind,)).fetchall()
+        return [(json.loads(key), json.loads(data)) for key, data in rows]
+
+    def _store(self, kind, key, data):
+        with self._lock:
+            if data is None:
+                self._connection.execute('DELETE FROM state WHERE kind = ? AND key = ?', (kind, json.dumps(key)))
+            else:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO state (kind, key, data) VALUES (?, ?, ?)',
+                    (kind, json.dumps(key), json.dumps(data)),
+                )
+
+    def get_user_data(self):
+        return defaultdict(dict, self._load('user'))
+
+    def get_chat_data(self):
+        return defaultdict(dict, self._load('chat'))
+
+    def get_bot_data(self):
+        data = self._load('bot')
+        return data[0][1] if data else {}
+
+    def get_conversations(self, name):
+        return {tuple(key): state for key, state in self._load(f'conversation:{name}')}
+
+    def update_conversation(self, name, key, new_state):
+        self._store(f'conversation:{name}', list(key), resolved_state(new_state))
+
+    def update_user_data(self, user_id, data):
+        self._store('user', user_id, data or None)
+
+    def update_chat_data(self, chat_id, data):
+        self._store('chat', chat_id, data or None)
+
+    def update_bot_data(self, data):
+        self._store('bot', 0, data or None)
+
+    def flush(self):
+        with self._lock:
+            self._connection.close()
+
+
+PERSISTENCE_BACKENDS = {
+    'file': FilePersistence,
+    'sqlite': SqlitePersistence,
+}
+
+
+def get_persistence(backend, filename):
+    """
+    Build the persistence of the conversations, or return `None` to keep them in memory only.
+
+    `backend` is either `file`, to pickle them to `filename`, or `sqlite`, to store them in a SQLite database.
+    """
+    if not backend:
+        return None
+    try:
+        persistence_class = PERSISTENCE_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f'Unknown persistence backend {backend}, use one of {", ".join(PERSISTENCE_BACKENDS)}')
+    logger.info('Persisting conversations', extra={'backend': backend, 'filename': filename})
+    return persistence_class(filename, store_bot_data=False)
@@ -1,40 +1,98 @@
+import atexit
+import copy
+import json
 import logging
-import logging.config
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+from peewee import Model
+
+
+class ModelRef:
+    """
+    Log-safe reference to a model instance, rendered from its primary key so logging never queries the database.
+    """
+    __slots__ = ('model', 'pk')
+
+    def __init__(self, instance: Model):
+        self.model = type(instance).__name__
+        self.pk = instance.get_id()
+
+    def __str__(self):
+        return f'<{self.model} #{self.pk}>'
 
 
 class ContextLogger(logging.Logger):
-    def _log(self, level, msg, args, exc_info=None, extra=None, **kwargs):
-        msg = f"{msg}: "
-        if extra:
-            msg = f"{msg}{'; '.join((f'{k}={v}' for k, v in extra.items()))}"
-        super()._log(level, msg, args, exc_info, extra, **kwargs)
+    """
+    Keep the `extra` arguments in the record `context`, to be formatted only if the record is emitted.
+    """
+
+    def _log(self, level, msg, args, exc_info=None, extra=None, stack_info=False, stacklevel=1):
+        context = {k: ModelRef(v) if isinstance(v, Model) else v for k, v in (extra or {}).items()}
+        # One more frame up, so records point to the caller instead of this method
+        super()._log(level, msg, args, exc_info, {"context": context}, stack_info, stacklevel + 1)
 
 
 logging.setLoggerClass(ContextLogger)
 
 
-def setup_logger(lvl="info"):
-
-    LOGGING_CONFIG = {
-        "version": 1,
-        "formatters": {
-            "standard": {
-                "format": "%(asctime)s [%(levelname)s] %(module)s:%(funcName)s %(message)s"
-            },
-        },
-        "handlers": {
-            "default": {
-                "level": lvl.upper(),
-                "formatter": "standard",
-                "class": "logging.StreamHandler",
-            },
-        },
-        "loggers": {
-            "main": {
-                "handlers": ["default"],
-                "level": lvl.upper(),
-            },
-        },
-    }
-
-    logging.config.dictConfig(LOGGING_CONFIG)
+class ContextFormatter(logging.Formatter):
+    def format(self, record):
+        context = getattr(record, "context", {})
+        record.context_display = "; ".join(f"{k}={v}" for k, v in context.items())
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "module": record.module,
+            "function": record.funcName,
+            "message": record.getMessage(),
+            **getattr(record, "context", {}),
+        }
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line["exception"] = record.exc_text
+        return json.dumps(line, default=str)
+
+
+class ContextQueueHandler(QueueHandler):
+    """
+    Hand the records over to a `QueueListener` thread, leaving all the formatting to it.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logger(lvl="info", fmt="text"):
+    """
+    Log to stderr through a queue, so threads never block on I/O. `fmt` is either `text` or `json` lines.
+    """
+    if fmt == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = ContextFormatter(
+            "%(asctime)s [%(levelname)s] %(module)s:%(funcName)s %(message)s: %(context_display)s"
+        )
+    handler = logging.StreamHandler()
+    handler.setLevel(lvl.upper())
+    handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    logger = logging.getLogger("main")
+    logger.setLevel(lvl.upper())
+    logger.handlers = [ContextQueueHandler(records)]
+    listener.start()
+    atexit.register(listener.stop)
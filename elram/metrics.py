@@ -0,0 +1,47 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+logger = logging.getLogger('main')
+
+COMMAND_SECONDS = Histogram(
+    'elram_command_seconds',
+    'Time to handle a message in the main conversation, by command.',
+    ['command'],
+)
+DB_QUERIES = Counter('elram_db_queries_total', 'Queries executed in the database.')
+DB_QUERY_SECONDS = Histogram(
+    'elram_db_query_seconds',
+    'Time to execute a query in the database.',
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, float('inf')),
+)
+TELEGRAM_SECONDS = Histogram('elram_telegram_seconds', 'Time of the Telegram API calls, by method.', ['method'])
+TELEGRAM_ERRORS = Counter('elram_telegram_errors_total', 'Failed Telegram API calls, by method.', ['method'])
+DISPATCHER_QUEUE_DEPTH = Gauge('elram_dispatcher_queue_depth', 'Updates waiting to be dispatched.')
+ACTIVE_CONVERSATIONS = Gauge('elram_active_conversations', 'Conversations that are not finished.')
+
+
+@contextmanager
+def observe_telegram(method):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        TELEGRAM_ERRORS.labels(method).inc()
+        raise
+    finally:
+        TELEGRAM_SECONDS.labels(method).observe(time.perf_counter() - start)
+
+
+def start_metrics_server(port, addr='127.0.0.1', dispatcher=None, conversation_handler=None):
+    """
+    Serve the metrics in the Prometheus text format on `addr:port`, local only by default.
+    """
+    if dispatcher is not None:
+        DISPATCHER_QUEUE_DEPTH.set_function(dispatcher.update_queue.qsize)
+    if conversation_handler is not None:
+        ACTIVE_CONVERSATIONS.set_function(lambda: len(conversation_handler.conversations))
+    start_http_server(port, addr=addr)
+    logger.info('Serving metrics', extra={'addr': addr, 'port': port})
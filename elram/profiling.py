@@ -0,0 +1,84 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import attr
+
+from elram.config import load_config
+from elram.metrics import DB_QUERIES, DB_QUERY_SECONDS
+
+CONFIG = load_config()
+logger = logging.getLogger('main')
+_local = threading.local()
+
+
+@attr.s
+class CommandProfile:
+    command: str = attr.ib(default=None)
+    queries: int = attr.ib(default=0)
+    db_time: float = attr.ib(default=0.0)
+    telegram_time: float = attr.ib(default=0.0)
+    start: float = attr.ib(factory=time.perf_counter)
+
+    @contextmanager
+    def telegram(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.telegram_time += time.perf_counter() - start
+
+    def as_dict(self):
+        return {
+            'command': self.command,
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 2),
+            'telegram_ms': round(self.telegram_time * 1000, 2),
+            'total_ms': round((time.perf_counter() - self.start) * 1000, 2),
+        }
+
+
+@contextmanager
+def profile_command():
+    """
+    Collect the queries and the time spent in the database and in Telegram while handling an update in this thread.
+    """
+    profile = CommandProfile()
+    _local.profile = profile
+    try:
+        yield profile
+    finally:
+        _local.profile = None
+
+
+def get_profile():
+    return getattr(_local, 'profile', None)
+
+
+class ProfiledDatabaseMixin:
+    """
+    Add the queries to the profile of the command being handled, and log the ones slower than `SLOW_QUERY_MS`.
+    """
+
+    def execute_sql(self, sql, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            DB_QUERIES.inc()
+            DB_QUERY_SECONDS.observe(elapsed)
+            profile = get_profile()
+            if profile is not None:
+                profile.queries += 1
+                profile.db_time += elapsed
+            if elapsed * 1000 >= CONFIG['SLOW_QUERY_MS']:
+                logger.warning(
+                    'Slow query',
+                    extra={
+                        'ms': round(elapsed * 1000, 2),
+                        'command': profile and profile.command,
+                        'sql': sql,
+                    }
+                )
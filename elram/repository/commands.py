@@ -1,33 +1,341 @@
 import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from decimal import Decimal
+from urllib.parse import urlparse
+
+import ijson
+from ijson.common import ObjectBuilder
+from peewee import ForeignKeyField, IntegerField
+from playhouse.migrate import SchemaMigrator, migrate
 
 from elram.config import load_config
-from elram.repository.models import User, database, Event, Attendance, Account, Transaction
+from elram.repository.models import User, database, Event, Attendance, Account, Transaction, PostgresqlPool, \
+    SchemaMigration, Balance, MemberBalance, FinancialSnapshot, Tenant
 
 CONFIG = load_config()
 logger = logging.getLogger('main')
 
 
-def populate_db(data):
-    models_mapping = {
-        'users': User,
-        'accounts': Account,
-    }
+MODELS = [
+    Tenant, User, Event, Attendance, Account, Transaction, Balance, MemberBalance, FinancialSnapshot, SchemaMigration,
+]
+MODELS_MAPPING = {
+    'users': User,
+    'accounts': Account,
+    'events': Event,
+    'attendances': Attendance,
+    'transactions': Transaction,
+}
+# Models whose records belong to a tenant
+TENANT_MODELS = (User, Event, Account, Transaction)
+# Fields that identify the records of each model within its tenant, to find the ids they were inserted with
+NATURAL_KEYS = {
+    User: (User.nickname,),
+    Account: (Account.name,),
+    Event: (Event.code,),
+    Attendance: (Attendance.event, Attendance.attendee),
+}
+
+
+@contextmanager
+def open_bootstrap_source(source):
+    """
+    Open the bootstrap document as a binary stream, either from a local path or downloading it from an URL.
+    """
+    if urlparse(source).scheme in ('http', 'https'):
+        # Only needed to download the document, and slow to import
+        import requests
+
+        with requests.get(source, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            yield response.raw
+    else:
+        with open(source, 'rb') as stream:
+            yield stream
+
+
+def iter_records(stream):
+    """
+    Yield `(section, record)` for every item of the top level lists of the JSON document, without loading the whole
+    document in memory.
+    """
+    section, builder = None, None
+    for prefix, event, value in ijson.parse(stream):
+        if builder is None:
+            if event == 'start_map' and prefix.endswith('.item') and prefix.count('.') == 1:
+                section, builder = prefix[:-len('.item')], ObjectBuilder()
+                builder.event(event, value)
+            continue
+        builder.event(event, value)
+        if event == 'end_map' and prefix == f'{section}.item':
+            yield section, builder.value
+            section, builder = None, None
+
+
+def _record_value(record, field):
+    # Records can name their foreign keys either by field or by column
+    return record.get(field.name, record.get(field.column_name))
+
+
+def _references(model_class):
+    # Foreign keys to the records of the document
+    return [field for field in model_class._meta.refs if field.rel_model in MODELS_MAPPING.values()]
+
+
+def _remap_references(section, record, ids):
+    """
+    Replace the document ids the record refers to with the ids of the records inserted for them.
+    """
+    for field in _references(MODELS_MAPPING[section]):
+        key = field.name if field.name in record else field.column_name
+        if record.get(key) is None:
+            continue
+        try:
+            record[key] = ids[field.rel_model][record[key]]
+        except KeyError:
+            raise ValueError(
+                f'A record of {section} refers to the {field.rel_model.__name__} {record[key]}, which is not in the '
+                f'document before it'
+            )
+
+
+def _insert_batch(model_class, batch, tenant, ids):
+    """
+    Insert the `(document_id, record)` pairs of `batch`, and add the ids they got to `ids`.
+    """
+    model_class.insert_many([record for _, record in batch]).execute()
+    logger.info('Records created', extra={'model': model_class.__name__, 'records': len(batch)})
+    key_fields = NATURAL_KEYS.get(model_class)
+    referable = [(document_id, record) for document_id, record in batch if document_id is not None]
+    if key_fields is None or not referable:
+        return
+    # Created rows are read back instead of using `RETURNING`, which not every backend supports
+    query = model_class.select().where(key_fields[0].in_([_record_value(r, key_fields[0]) for _, r in referable]))
+    if model_class in TENANT_MODELS:
+        query = query.where(model_class.tenant == tenant)
+    inserted = {tuple(row.__data__[field.name] for field in key_fields): row.id for row in query}
+    ids[model_class].update({
+        document_id: inserted[tuple(_record_value(record, field) for field in key_fields)]
+        for document_id, record in referable
+    })
+
+
+def populate_db(stream, tenant, batch_size=CONFIG['BOOTSTRAP_BATCH_SIZE']):
+    """
+    Load the records of the bootstrap document into `tenant`, inserting them in batches of `batch_size` inside a
+    transaction.
+
+    The document is a JSON object with a list of records for any of the `MODELS_MAPPING` sections. Records refer to
+    each other by their ids in the document, and they are inserted with new ids, so records can only refer to the ones
+    that come before them in the document.
+    """
+    loaded = set()
+    # Ids the records were inserted with by model and document id
+    ids = defaultdict(dict)
+    model_class, batch = None, []
+    with database.atomic():
+        for section, record in iter_records(stream):
+            section_class = MODELS_MAPPING.get(section)
+            if section_class is None:
+                if section not in loaded:
+                    logger.error('No model class found', extra={'model_key': section})
+                    loaded.add(section)
+                continue
+            if section_class is not model_class or len(batch) >= batch_size:
+                if batch:
+                    _insert_batch(model_class, batch, tenant, ids)
+                model_class, batch = section_class, []
+            if section_class in TENANT_MODELS:
+                record['tenant'] = tenant.id
+            document_id = record.pop('id', None)
+            _remap_references(section, record, ids)
+            batch.append((document_id, record))
+            loaded.add(section)
+        if batch:
+            _insert_batch(model_class, batch, tenant, ids)
+        if 'transactions' in loaded:
+            Balance.rebuild(Transaction.tenant == tenant)
+            MemberBalance.rebuild()
+    Account.invalidate_registry()
+
+
+class OutdatedSchema(Exception):
+    pass
+
+
+# Databases created before the migrations existed may already have some of their changes, so the operations below
+# skip what is already in place.
+
+def _add_index(migrator, table, columns, unique=False):
+    indexes = database.get_indexes(table)
+    if any(tuple(index.columns) == tuple(columns) for index in indexes):
+        return []
+    return [migrator.add_index(table, columns, unique=unique)]
 
-    for model_key, model_data in data.items():
-        model_class = models_mapping.get(model_key)
-        if model_class is None:
-            logger.error('No model class found', extra={'model_key': model_key})
+
+def _drop_index(migrator, table, index_name):
+    if index_name not in {index.name for index in database.get_indexes(table)}:
+        return []
+    return [migrator.drop_index(table, index_name)]
+
+
+def _add_column(migrator, table, column_name, field):
+    if column_name in {column.name for column in database.get_columns(table)}:
+        return []
+    return [migrator.add_column(table, column_name, field)]
+
+
+def _add_ledger_indexes(migrator):
+    return [
+        *_add_index(migrator, 'event', ('code',), unique=True),
+        *_add_index(migrator, 'event', ('datetime',)),
+        *_add_index(migrator, 'transaction', ('attendance_id', 'account_id')),
+    ]
+
+
+def _create_balances(migrator):
+    Balance.create_table()
+    # Member balances don't exist yet, they are built from these ones by the next migration
+    Balance.rebuild(Transaction.id.is_null(False), members=False)
+    return []
+
+
+def _create_member_balances(migrator):
+    MemberBalance.create_table()
+    MemberBalance.rebuild()
+    return []
+
+
+def _add_event_status(migrator):
+    FinancialSnapshot.create_table()
+    # Existing events stay active until they are closed
+    return _add_column(migrator, 'event', 'status', IntegerField(default=Event.ACTIVE))
+
+
+def _add_tenants(migrator):
+    Tenant.create_table()
+    # Everything that already exists belongs to the peña group the bot served so far
+    tenant = Tenant.get_default()
+    operations = []
+    for table, index in (('user', False), ('event', False), ('account', False), ('transaction', True)):
+        field = ForeignKeyField(Tenant, field=Tenant.id, default=tenant.id, index=index)
+        operations += _add_column(migrator, table, 'tenant_id', field)
+    operations += [
+        *_drop_index(migrator, 'user', 'user_nickname'),
+        *_drop_index(migrator, 'user', 'user_telegram_id'),
+        *_drop_index(migrator, 'event', 'event_code'),
+        *_drop_index(migrator, 'event', 'event_datetime'),
+        *_drop_index(migrator, 'account', 'account_name'),
+        *_add_index(migrator, 'user', ('tenant_id', 'nickname'), unique=True),
+        *_add_index(migrator, 'user', ('tenant_id', 'telegram_id'), unique=True),
+        *_add_index(migrator, 'event', ('tenant_id', 'code'), unique=True),
+        *_add_index(migrator, 'event', ('tenant_id', 'datetime')),
+        *_add_index(migrator, 'account', ('tenant_id', 'name'), unique=True),
+    ]
+    return operations
+
+
+# Versioned changes to the schema of existing databases, as `(version, description, operations)`. `operations` takes
+# a `SchemaMigrator` and returns the operations to run. Models must be updated to match, since new databases are
+# created straight from them.
+MIGRATIONS = [
+    (1, 'Index events by code and datetime, and transactions by attendance and account', _add_ledger_indexes),
+    (2, 'Create the balances of each attendance by account', _create_balances),
+    (3, 'Create the balances of each member by account', _create_member_balances),
+    (4, 'Add the status of the events and the financial snapshots of the closed ones', _add_event_status),
+    (5, 'Scope users, events, accounts and transactions to tenants', _add_tenants),
+]
+
+
+def migrate_db():
+    """
+    Apply the pending migrations, each one in its own transaction. Returns the applied versions.
+    """
+    migrator = SchemaMigrator.from_database(database.obj)
+    SchemaMigration.create_table()
+    current_version = SchemaMigration.get_version()
+    applied = []
+    for version, description, operations in MIGRATIONS:
+        if version <= current_version:
             continue
-        models = (model_class(**data) for data in model_data)
-        model_class.bulk_create(models)
-        logger.info(
-            'Records created',
-            extra={'model': model_class.__name__, 'records': len(model_data)},
+        with database.atomic():
+            migrate(*operations(migrator))
+            SchemaMigration.create(version=version, description=description)
+        logger.info('Migration applied', extra={'version': version, 'description': description})
+        applied.append(version)
+    return applied
+
+
+def _amounts(debit, credit):
+    return Decimal(str(debit or 0)), Decimal(str(credit or 0))
+
+
+def reconcile_balances(fix=False):
+    """
+    Compare the balances with the totals of the transactions, and rebuild them if `fix` is set.
+
+    Returns the `(attendance_id, account_id)` pairs whose balance doesn't match its transactions.
+    """
+    totals = {
+        (attendance_id, account_id): _amounts(debit, credit)
+        for attendance_id, account_id, debit, credit in Balance.totals(Transaction.id.is_null(False)).tuples()
+    }
+    balances = {
+        (attendance_id, account_id): _amounts(debit, credit)
+        for attendance_id, account_id, debit, credit in Balance
+        .select(Balance.attendance, Balance.account, Balance.debit, Balance.credit)
+        .tuples()
+    }
+    mismatches = sorted(
+        key for key in totals.keys() | balances.keys()
+        if totals.get(key, (0, 0)) != balances.get(key, (0, 0))
+    )
+    for attendance_id, account_id in mismatches:
+        logger.warning(
+            'Balance mismatch',
+            extra={
+                'attendance': attendance_id,
+                'account': account_id,
+                'balance': balances.get((attendance_id, account_id)),
+                'transactions': totals.get((attendance_id, account_id)),
+            }
         )
+    if fix and mismatches:
+        with database.atomic():
+            # Balances without transactions left are reset to zero by the rebuild
+            Balance.update(debit=0, credit=0).execute()
+            Balance.rebuild(Transaction.id.is_null(False))
+            MemberBalance.rebuild()
+    return mismatches
+
 
+def init_db(db_name, user, password, host, port, max_connections=8, stale_timeout=300, health_check=True,
+            check_schema=True):
+    """
+    Connect to the database, creating its tables if it's new.
 
-def init_db(db_name, user, password, host, port):
-    database.init(database=db_name, user=user, password=password, host=host, port=port)
-    database.connect()
-    database.create_tables([User, Event, Attendance, Account, Transaction])
+    Existing databases are never changed here, they are upgraded with `migrate_db`. Unless `check_schema` is false,
+    `OutdatedSchema` is raised if they have pending migrations.
+    """
+    database.initialize(PostgresqlPool(
+        db_name,
+        user=user,
+        password=password,
+        host=host,
+        port=port,
+        max_connections=max_connections,
+        stale_timeout=stale_timeout,
+        health_check=health_check,
+    ))
+    with database.connection_context():
+        if not database.table_exists(Event._meta.table_name):
+            # New databases are created with the latest schema
+            database.create_tables(MODELS)
+            SchemaMigration.insert_many([
+                {'version': version, 'description': description} for version, description, _ in MIGRATIONS
+            ]).execute()
+        elif check_schema and SchemaMigration.get_version() < MIGRATIONS[-1][0]:
+            raise OutdatedSchema('Database schema is outdated, run `elram migrate`')
     return database
@@ -1,16 +1,69 @@
 import datetime
+import json
 import logging
 import math
+from contextlib import nullcontext
+import threading
 
 import attr
-from peewee import (CharField, DateTimeField, IntegerField, Model, PostgresqlDatabase, BooleanField,
-                    ForeignKeyField, DecimalField, fn)
+import psycopg2
+from peewee import (CharField, DateTimeField, IntegerField, Model, BooleanField, ForeignKeyField, DecimalField,
+                    BigIntegerField, TextField, DatabaseProxy, EXCLUDED, Tuple, Value, fn, InterfaceError,
+                    OperationalError, SENTINEL)
+from playhouse.pool import PooledPostgresqlDatabase
+from playhouse.shortcuts import ReconnectMixin
 
 from elram.config import load_config
+from elram.profiling import ProfiledDatabaseMixin
 
-database = PostgresqlDatabase(None)
 CONFIG = load_config()
-logger = logging.getLogger(__name__)
+logger = logging.getLogger('main')
+
+
+class PostgresqlPool(ReconnectMixin, ProfiledDatabaseMixin, PooledPostgresqlDatabase):
+    """
+    Pool of Postgres connections, one per thread, that reconnects when the server drops them.
+
+    Queries are only retried outside transactions, since reconnecting drops the statements the transaction already
+    ran. If `health_check` is set, idle connections are pinged when they are checked out and discarded if the ping
+    fails.
+    """
+    reconnect_errors = (
+        (OperationalError, 'server closed the connection unexpectedly'),
+        (OperationalError, 'terminating connection due to administrator command'),
+        (OperationalError, 'could not receive data from server'),
+        (OperationalError, 'SSL connection has been closed unexpectedly'),
+        (InterfaceError, 'connection already closed'),
+    )
+
+    def init(self, database, health_check=True, **kwargs):
+        self.health_check = health_check
+        super().init(database, **kwargs)
+
+    def execute_sql(self, sql, params=None, commit=SENTINEL):
+        if self.in_transaction():
+            # Skip the reconnection
+            return super(ReconnectMixin, self).execute_sql(sql, params, commit)
+        return super().execute_sql(sql, params, commit)
+
+    def _is_closed(self, conn):
+        if super()._is_closed(conn):
+            return True
+        if not self.health_check:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            # Don't leave the connection idle in the transaction the ping opened
+            conn.rollback()
+        except psycopg2.Error:
+            logger.warning('Discarding broken connection', extra={'connection': id(conn)})
+            return True
+        return False
+
+
+# Initialized by `init_db`, so other backends can stand in for Postgres
+database = DatabaseProxy()
 
 
 class NotFound(Exception):
@@ -33,33 +86,89 @@ class BaseModel(Model):
         super().save(*args, **kwargs)
 
 
+class Tenant(BaseModel):
+    """
+    A peña group. Users, events, accounts and transactions belong to a single tenant.
+
+    Queries on those models must be scoped to the tenant, and their indexes are led by it.
+    """
+    DEFAULT_NAME = 'default'
+
+    name = CharField(unique=True)
+    # Telegram chat of the group. The tenant without chat serves the chats that don't belong to any other
+    chat_id = BigIntegerField(null=True, unique=True)
+    password = CharField()
+    event_weekday = IntegerField()
+    first_event_code = IntegerField(default=1)
+    first_event_host_nickname = CharField(null=True)
+
+    def __str__(self):
+        return f'<Tenant {self.name}>'
+
+    @classmethod
+    def get_for_chat(cls, chat_id):
+        return cls.select()\
+            .where((cls.chat_id == chat_id) | cls.chat_id.is_null())\
+            .order_by(cls.chat_id.is_null())\
+            .first()
+
+    @classmethod
+    def get_default(cls):
+        """
+        Get the tenant of the single peña group the bot served before tenants existed, created from the settings.
+        """
+        tenant, _ = cls.get_or_create(
+            name=cls.DEFAULT_NAME,
+            defaults={
+                'password': CONFIG['PASSWORD'],
+                'event_weekday': CONFIG['EVENT_WEEKDAY'],
+                'first_event_code': CONFIG['FIRST_EVENT_CODE'],
+                'first_event_host_nickname': CONFIG['FIRST_EVENT_HOST_NICKNAME'],
+            },
+        )
+        return tenant
+
+
 class User(BaseModel):
-    telegram_id = IntegerField(null=True, unique=True)
+    # Indexed by the composite indexes it leads
+    tenant = ForeignKeyField(Tenant, related_name='users', index=False)
+    telegram_id = IntegerField(null=True)
     first_name = CharField(null=True)
     last_name = CharField(null=True)
-    nickname = CharField(unique=True)
+    nickname = CharField()
     is_staff = BooleanField(default=False)
     hidden = BooleanField(default=False)
     is_host = BooleanField(default=False)
 
+    class Meta:
+        indexes = (
+            (('tenant', 'nickname'), True),
+            (('tenant', 'telegram_id'), True),
+        )
+
     def __str__(self):
         return self.nickname
 
     @classmethod
-    def get_future_hosts(cls):
+    def get_future_hosts(cls, tenant):
         return User.select() \
             .join(Attendance) \
             .join(Event) \
-            .where(Attendance.is_host & (Event.datetime >= datetime.datetime.now()) & ~User.hidden)\
+            .where(
+                (User.tenant == tenant)
+                & Attendance.is_host
+                & (Event.datetime >= datetime.datetime.now())
+                & ~User.hidden
+            )\
             .order_by(User.last_name.desc())
 
     @classmethod
-    def get_hosts(cls):
-        return User.select().where(cls.is_host & ~cls.hidden)
+    def get_hosts(cls, tenant):
+        return User.select().where((cls.tenant == tenant) & cls.is_host & ~cls.hidden)
 
     @classmethod
-    def get_hidden_host(cls):
-        return cls.select().where(cls.hidden).first()
+    def get_hidden_host(cls, tenant):
+        return cls.select().where((cls.tenant == tenant) & cls.hidden).first()
 
 
 class Event(BaseModel):
@@ -88,15 +197,46 @@ class Event(BaseModel):
     }
     DRAFT, ACTIVE, CLOSED, ABANDONED = range(4)
 
+    tenant = ForeignKeyField(Tenant, related_name='events', index=False)
     datetime: datetime = DateTimeField()
     code: int = IntegerField()
+    status: int = IntegerField(default=ACTIVE)
+
+    class Meta:
+        indexes = (
+            (('tenant', 'code'), True),
+            (('tenant', 'datetime'), False),
+        )
 
     def refresh(self):
         return type(self).get(self._pk_expr())
 
+    @classmethod
+    def touch(cls, event_id):
+        """
+        Bump the `updated` stamp of the event without going through `save`.
+
+        Must be called on every write to the event attendances or transactions, since the stamp is used as the
+        version of the rendered event message.
+        """
+        cls.update(updated=datetime.datetime.now()).where(cls.id == event_id).execute()
+
+    @classmethod
+    def get_status(cls, event_id, for_update=False):
+        """
+        Get the status of the event. If `for_update`, the event row is locked until the transaction ends, so the
+        writes to the event run one after the other.
+
+        Backends without row locks, like SQLite, serialize the writes on their own.
+        """
+        query = cls.select(cls.status).where(cls.id == event_id)
+        if for_update and database.for_update:
+            query = query.for_update()
+        return query.scalar()
+
     @property
-    def hidden_host(self):
-        return self.attendees.join(User).where(User.hidden).first()
+    def is_closed(self):
+        return self.status == self.CLOSED
 
     @property
     def datetime_display(self):
@@ -104,27 +244,16 @@ class Event(BaseModel):
         spanish_month = self.SPANISH_MONTHS[self.datetime.month]
         return f'{spanish_weekday} {self.datetime.day} de {spanish_month}'
 
-    @property
-    def host(self):
-        return self.attendees.where(Attendance.is_host == True).first().attendee
-
-    @property
-    def effective_attendees(self):
-        return self.attendees.join(User).where(~User.hidden)
-
     @classmethod
-    def get_next_event(cls):
-        return cls.select().where(cls.datetime > datetime.datetime.now()).order_by(cls.code).first()
+    def get_next_event(cls, tenant):
+        return cls.select()\
+            .where((cls.tenant == tenant) & (cls.datetime > datetime.datetime.now()))\
+            .order_by(cls.code)\
+            .first()
 
     @classmethod
-    def get_last_event(cls):
-        return cls.select().order_by(cls.created.desc()).first()
-
-    def find_attendee(self, nickname):
-        attendee = self.effective_attendees.where(User.nickname == nickname).first()
-        if attendee is None:
-            raise AttendeeNotFound(f'{nickname} no es asistente de esta peña.')
-        return attendee
+    def get_last_event(cls, tenant):
+        return cls.select().where(cls.tenant == tenant).order_by(cls.created.desc()).first()
 
     def add_host(self, host):
         """
@@ -141,6 +270,7 @@ class Event(BaseModel):
             Attendance.update(is_host=True)\
                 .where(Attendance.event == self, Attendance.attendee == host)\
                 .execute()
+            self.touch(self.id)
 
     def replace_host(self, host):
         if host.hidden:
@@ -148,7 +278,7 @@ class Event(BaseModel):
 
         # Make old host normal attendee
         Attendance.update(is_host=False)\
-            .where(Attendance.event == self, Attendance.attendee == self.host)\
+            .where(Attendance.event == self, Attendance.is_host == True)\
             .execute()
         self.add_host(host)
 
@@ -165,21 +295,53 @@ class Event(BaseModel):
         if attendee.hidden:
             return
 
-        Attendance.delete()\
-            .where(Attendance.event == self, Attendance.attendee == attendee)\
-            .execute()
+        attendances = Attendance.select(Attendance.id)\
+            .where(Attendance.event == self, Attendance.attendee == attendee)
+        with database.atomic():
+            # Balances are deleted in cascade, so they have to be taken out of the member totals first
+            MemberBalance.add_from_balances(Balance.attendance.in_(attendances), sign=-1)
+            Attendance.delete()\
+                .where(Attendance.event == self, Attendance.attendee == attendee)\
+                .execute()
+        self.touch(self.id)
 
-    def display_attendees(self):
-        attendees = self.effective_attendees
-        attendees_names = '\n'.join([f'{i + 1}\- {a.attendee.nickname}' for i, a in enumerate(attendees)])
-        return f'Hasta ahora van:\n{attendees_names}\n'
+    def snapshot(self):
+        return EventSnapshot.load(self)
 
     def __str__(self):
         return f'<Event #{self.code}>'
 
 
 class Account(BaseModel):
-    name = CharField(unique=True)
+    NAMES = ('Expenses', 'Refunds', 'Social Fees', 'Contributions')
+
+    tenant = ForeignKeyField(Tenant, related_name='accounts', index=False)
+    name = CharField()
+
+    class Meta:
+        indexes = (
+            (('tenant', 'name'), True),
+        )
+
+    # Accounts are reference data, so they are loaded once per process and shared by tenant and name.
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    @classmethod
+    def get_by_name(cls, tenant_id, name):
+        account = cls._registry.get((tenant_id, name))
+        if account is None:
+            with cls._registry_lock:
+                cls._registry = {(a.tenant_id, a.name): a for a in cls.select()}
+            account = cls._registry.get((tenant_id, name))
+        if account is None:
+            raise cls.DoesNotExist(f'No account named {name} for tenant {tenant_id}')
+        return account
+
+    @classmethod
+    def invalidate_registry(cls):
+        with cls._registry_lock:
+            cls._registry = {}
 
     def __str__(self):
         return f'<Account {self.name}>'
@@ -195,6 +357,10 @@ class Attendance(BaseModel):
             (('attendee', 'event'), True),
         )
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        Event.touch(self.event_id)
+
     @property
     def debit(self):
         return self.get_debit()
@@ -203,26 +369,24 @@ class Attendance(BaseModel):
     def credit(self):
         return self.get_credit()
 
-    def get_debit(self, account: Account = None):
-        debit = Transaction\
-            .select(fn.SUM(Transaction.debit))\
-            .where(Transaction.attendance == self)
+    def _get_totals(self, account: Account = None):
+        totals = Balance\
+            .select(fn.SUM(Balance.debit), fn.SUM(Balance.credit))\
+            .where(Balance.attendance == self)
         if account is not None:
-            debit = debit.where(Transaction.account == account)
-        debit = debit.scalar()
-        return debit or 0
+            totals = totals.where(Balance.account == account)
+        debit, credit = totals.scalar(as_tuple=True)
+        return debit or 0, credit or 0
+
+    def get_debit(self, account: Account = None):
+        return self._get_totals(account)[0]
 
     def get_credit(self, account: Account = None):
-        credit = Transaction\
-            .select(fn.SUM(Transaction.credit))\
-            .where(Transaction.attendance == self)
-        if account is not None:
-            credit = credit.where(Transaction.account == account)
-        credit = credit.scalar()
-        return credit or 0
+        return self._get_totals(account)[1]
 
     def get_account_balance(self, account: Account = None):
-        return self.get_debit(account) - self.get_credit(account)
+        debit, credit = self._get_totals(account)
+        return debit - credit
 
     def get_transactions(self, account: Account = None):
         transactions = Transaction.select().where(Transaction.attendance == self)
@@ -232,10 +396,11 @@ class Attendance(BaseModel):
 
     @property
     def balance(self):
-        return self.debit - self.credit
+        return self.get_account_balance()
 
     def add_credit(self, amount, account, description=None):
         return Transaction.create(
+            tenant=account.tenant_id,
             attendance=self,
             account=account,
             credit=amount,
@@ -244,6 +409,7 @@ class Attendance(BaseModel):
 
     def add_debit(self, amount, account, description=None):
         return Transaction.create(
+            tenant=account.tenant_id,
             attendance=self,
             account=account,
             debit=amount,
@@ -255,12 +421,276 @@ class Attendance(BaseModel):
 
 
 class Transaction(BaseModel):
+    tenant = ForeignKeyField(Tenant, related_name='transactions')
     attendance = ForeignKeyField(Attendance, related_name='transactions', on_delete='cascade')
     account = ForeignKeyField(Account, related_name='transactions')
     description = CharField(default='')
     debit = DecimalField(default=0)
     credit = DecimalField(default=0)
 
+    class Meta:
+        indexes = (
+            (('attendance', 'account'), False),
+        )
+
+    def save(self, *args, **kwargs):
+        is_new = self.get_id() is None
+        # Savepoints aren't needed when a transaction is already open
+        with nullcontext() if database.in_transaction() else database.atomic():
+            super().save(*args, **kwargs)
+            if is_new:
+                Balance.add(self.attendance_id, self.account_id, self.debit, self.credit)
+            else:
+                Balance.rebuild(
+                    (Transaction.attendance == self.attendance_id) & (Transaction.account == self.account_id)
+                )
+        Event.touch(Attendance.select(Attendance.event).where(Attendance.id == self.attendance_id))
+
+
+class Balance(BaseModel):
+    """
+    Running debit and credit totals of the transactions of each attendance in each account.
+
+    Kept up to date by `Transaction.save`. Writes that bypass it, like bulk inserts and updates, must call `rebuild`
+    for the rows they touch in the same transaction.
+    """
+    attendance = ForeignKeyField(Attendance, related_name='balances', on_delete='cascade')
+    account = ForeignKeyField(Account, related_name='balances')
+    debit = DecimalField(default=0)
+    credit = DecimalField(default=0)
+
+    class Meta:
+        indexes = (
+            (('attendance', 'account'), True),
+        )
+
+    @classmethod
+    def add(cls, attendance_id, account_id, debit, credit):
+        MemberBalance.add_from(
+            Attendance.select(Attendance.attendee, Value(account_id), Value(debit), Value(credit))
+            .where(Attendance.id == attendance_id)
+        )
+        cls.insert(attendance=attendance_id, account=account_id, debit=debit, credit=credit)\
+            .on_conflict(
+                conflict_target=[cls.attendance, cls.account],
+                update={
+                    cls.debit: cls.debit + EXCLUDED.debit,
+                    cls.credit: cls.credit + EXCLUDED.credit,
+                    cls.updated: EXCLUDED.updated,
+                },
+            )\
+            .execute()
+
+    @classmethod
+    def totals(cls, where):
+        """
+        Debit and credit totals of the transactions matching `where`, by attendance and account.
+        """
+        return Transaction\
+            .select(
+                Transaction.attendance,
+                Transaction.account,
+                fn.SUM(Transaction.debit),
+                fn.SUM(Transaction.credit),
+            )\
+            .where(where)\
+            .group_by(Transaction.attendance, Transaction.account)
+
+    @classmethod
+    def rebuild(cls, where, members=True):
+        """
+        Recompute the balances of the transactions matching `where` from the ledger.
+
+        The member balances are moved along with them, unless `members` is false.
+        """
+        pairs = cls.totals(where).select(Transaction.attendance, Transaction.account)
+        affected = Tuple(cls.attendance, cls.account).in_(pairs)
+        if members:
+            # Members balances are moved by the difference between the old balances and the rebuilt ones
+            MemberBalance.add_from_balances(affected, sign=-1)
+        now = datetime.datetime.now()
+        cls.insert_from(
+            cls.totals(where).select_extend(Value(now), Value(now)),
+            [cls.attendance, cls.account, cls.debit, cls.credit, cls.created, cls.updated],
+        )\
+            .on_conflict(
+                conflict_target=[cls.attendance, cls.account],
+                update={cls.debit: EXCLUDED.debit, cls.credit: EXCLUDED.credit, cls.updated: EXCLUDED.updated},
+            )\
+            .execute()
+        if members:
+            MemberBalance.add_from_balances(affected)
+
+
+class MemberBalance(BaseModel):
+    """
+    Debit and credit totals of each user in each account, across all the events.
+
+    Moved along with `Balance`, so it must be updated whenever balances are written or deleted.
+    """
+    user = ForeignKeyField(User, related_name='balances', on_delete='cascade')
+    account = ForeignKeyField(Account, related_name='member_balances')
+    debit = DecimalField(default=0)
+    credit = DecimalField(default=0)
+
+    class Meta:
+        indexes = (
+            (('user', 'account'), True),
+        )
+
+    @classmethod
+    def add_from(cls, query):
+        """
+        Add the `(user, account, debit, credit)` rows selected by `query` to the totals.
+        """
+        now = datetime.datetime.now()
+        cls.insert_from(
+            query.select_extend(Value(now), Value(now)),
+            [cls.user, cls.account, cls.debit, cls.credit, cls.created, cls.updated],
+        )\
+            .on_conflict(
+                conflict_target=[cls.user, cls.account],
+                update={
+                    cls.debit: cls.debit + EXCLUDED.debit,
+                    cls.credit: cls.credit + EXCLUDED.credit,
+                    cls.updated: EXCLUDED.updated,
+                },
+            )\
+            .execute()
+
+    @classmethod
+    def add_from_balances(cls, where, sign=1):
+        """
+        Add the balances matching `where` to the totals of their users, or subtract them if `sign` is -1.
+        """
+        cls.add_from(
+            Balance
+            .select(Attendance.attendee, Balance.account, fn.SUM(Balance.debit) * sign, fn.SUM(Balance.credit) * sign)
+            .join(Attendance)
+            .where(where)
+            .group_by(Attendance.attendee, Balance.account)
+        )
+
+    @classmethod
+    def rebuild(cls):
+        cls.delete().execute()
+        cls.add_from_balances(Balance.id.is_null(False))
+
+    @classmethod
+    def get_totals(cls, user: User):
+        """
+        Return the `(account, debit, credit)` totals of the user.
+        """
+        return [
+            (balance.account, balance.debit, balance.credit)
+            for balance in cls.select(cls, Account).join(Account).where(cls.user == user).order_by(Account.id)
+        ]
+
+
+class SchemaMigration(BaseModel):
+    """
+    Migrations applied to the database schema, see `elram.repository.commands.MIGRATIONS`.
+    """
+    version = IntegerField(unique=True)
+    description = CharField()
+
+    @classmethod
+    def get_version(cls):
+        if not cls.table_exists():
+            # Databases created before the migrations
+            return 0
+        return cls.select(fn.MAX(cls.version)).scalar() or 0
+
+
+class FinancialSnapshot(BaseModel):
+    """
+    Financial status of an event frozen when it was closed, along with its rendered message.
+    """
+    event = ForeignKeyField(Event, related_name='financial_snapshots', unique=True, on_delete='cascade')
+    total_cost = DecimalField(default=0)
+    cost_per_capita = DecimalField(default=0)
+    effective_cost_per_capita = DecimalField(default=0)
+    per_capita_contribution = DecimalField(default=0)
+    # JSON object with the balance of each effective attendee by nickname
+    balances = TextField(default='{}')
+    message = TextField()
+
+    @classmethod
+    def freeze(cls, financial_status: 'EventFinancialStatus', message: str):
+        return cls.create(
+            event=financial_status.event,
+            total_cost=financial_status.total_cost,
+            cost_per_capita=financial_status.cost_per_capita,
+            effective_cost_per_capita=financial_status.effective_cost_per_capita,
+            per_capita_contribution=financial_status.per_capita_contribution,
+            balances=json.dumps({
+                attendance.attendee.nickname: str(round(financial_status.get_balance(attendance), 2))
+                for attendance in financial_status.effective_attendances
+            }),
+            message=message,
+        )
+
+    @classmethod
+    def get_message(cls, event_id):
+        return cls.select(cls.message).where(cls.event == event_id).scalar()
+
+    def get_balances(self):
+        return json.loads(self.balances)
+
+    def __str__(self):
+        return f'<FinancialSnapshot #{self.event_id}>'
+
+
+@attr.s
+class EventSnapshot:
+    """
+    An event along with all its attendances and their users, loaded in a single joined query.
+    """
+    event: Event = attr.ib()
+    attendances: list = attr.ib(factory=list)
+
+    @classmethod
+    def load(cls, event: Event):
+        attendances = list(
+            Attendance.select(Attendance, User)
+            .join(User)
+            .where(Attendance.event == event)
+            .order_by(Attendance.id)
+        )
+        for attendance in attendances:
+            attendance.event = event
+        return cls(event=event, attendances=attendances)
+
+    @property
+    def effective_attendances(self):
+        return [a for a in self.attendances if not a.attendee.hidden]
+
+    @property
+    def hidden_host(self):
+        return next((a for a in self.attendances if a.attendee.hidden), None)
+
+    @property
+    def host(self):
+        return next((a.attendee for a in self.attendances if a.is_host), None)
+
+    def is_attendee(self, user: User):
+        return any(a.attendee_id == user.id for a in self.attendances)
+
+    def find_attendee(self, nickname):
+        attendee = next((a for a in self.effective_attendances if a.attendee.nickname == nickname), None)
+        if attendee is None:
+            raise AttendeeNotFound(f'{nickname} no es asistente de esta peña.')
+        return attendee
+
+    def display_attendees(self):
+        attendees_names = '\n'.join(
+            [f'{i + 1}\- {a.attendee.nickname}' for i, a in enumerate(self.effective_attendances)]
+        )
+        return f'Hasta ahora van:\n{attendees_names}\n'
+
+    def __str__(self):
+        return f'<EventSnapshot #{self.event.code}>'
+
 
 @attr.s
 class EventFinancialStatus:
@@ -269,26 +699,72 @@ class EventFinancialStatus:
     refund_account: Account = attr.ib()
     social_fee_account: Account = attr.ib()
     contribution_account: Account = attr.ib()
+    snapshot: EventSnapshot = attr.ib(default=None)
     _total_expense = attr.ib(init=False, default=None)
     _cost_per_capita = attr.ib(init=False, default=None)
     _per_capita_contribution = attr.ib(init=False, default=None)
     _effective_cost_per_capita = attr.ib(init=False, default=None)
-    _attendees_count = attr.ib(init=False, default=None)
-    _hidden_host_balance = attr.ib(init=False, default=None)
+    _ledger = attr.ib(init=False, default=None)
+
+    def __attrs_post_init__(self):
+        if self.snapshot is None:
+            self.snapshot = EventSnapshot.load(self.event)
+
+    @property
+    def effective_attendances(self):
+        return self.snapshot.effective_attendances
+
+    @property
+    def hidden_host(self):
+        return self.snapshot.hidden_host
+
+    @property
+    def ledger(self):
+        """
+        Debit and credit of every attendance of the event, by account.
+
+        Loaded from the balances with a single query and keyed by `(attendance_id, account_id)`.
+        """
+        if self._ledger is None:
+            query = Balance\
+                .select(Balance.attendance, Balance.account, Balance.debit, Balance.credit)\
+                .join(Attendance)\
+                .where(Attendance.event == self.event)\
+                .tuples()
+            self._ledger = {
+                (attendance_id, account_id): (debit or 0, credit or 0)
+                for attendance_id, account_id, debit, credit in query
+            }
+        return self._ledger
+
+    def _sum_ledger(self, position, attendance: Attendance = None, account: Account = None):
+        return sum(
+            (
+                amounts[position]
+                for (attendance_id, account_id), amounts in self.ledger.items()
+                if (attendance is None or attendance_id == attendance.id)
+                and (account is None or account_id == account.id)
+            ),
+            0,
+        )
+
+    def get_debit(self, attendance: Attendance = None, account: Account = None):
+        return self._sum_ledger(0, attendance, account)
+
+    def get_credit(self, attendance: Attendance = None, account: Account = None):
+        return self._sum_ledger(1, attendance, account)
+
+    def get_balance(self, attendance: Attendance = None, account: Account = None):
+        return self.get_debit(attendance, account) - self.get_credit(attendance, account)
 
     @property
     def attendees_count(self):
-        if self._attendees_count is None:
-            self._attendees_count = self.event.effective_attendees.count()
-        return self._attendees_count
+        return len(self.effective_attendances)
 
     @property
     def total_cost(self):
         if self._total_expense is None:
-            self._total_expense = round(sum(
-                a.get_credit(account=self.cost_account)
-                for a in self.event.attendees
-            ), 2)
+            self._total_expense = round(self.get_credit(account=self.cost_account), 2)
         return self._total_expense
 
     @property
@@ -314,10 +790,10 @@ class EventFinancialStatus:
         return self._effective_cost_per_capita
 
     def display(self):
-        effective_attendees = self.event.effective_attendees
+        effective_attendees = self.effective_attendances
         msg = f'En total se gastó `{self.total_cost}`\n'
         for attendance in effective_attendees:
-            credit = round(attendance.get_credit(self.cost_account), 2)
+            credit = round(self.get_credit(attendance, self.cost_account), 2)
             if credit > 0:
                 msg += f'\* {attendance.attendee} gastó `{credit}`\n'
 
@@ -326,7 +802,7 @@ class EventFinancialStatus:
         incomming = 0
 
         for attendance in effective_attendees:
-            balance = round(attendance.balance, 2)
+            balance = round(self.get_balance(attendance), 2)
             if not balance:
                 msg += f'\* {attendance.attendee} 👍\n'
             elif balance > 0:
@@ -336,9 +812,9 @@ class EventFinancialStatus:
                 debts += balance
                 msg += f'\* {attendance.attendee} tiene que recibir `{abs(balance)}`\n'
 
-        hidden_host = self.event.hidden_host
-        refund_balance = hidden_host.get_account_balance(self.refund_account)
-        contribution_balance = abs(hidden_host.get_account_balance(self.contribution_account))
+        hidden_host = self.hidden_host
+        refund_balance = self.get_balance(hidden_host, self.refund_account)
+        contribution_balance = abs(self.get_balance(hidden_host, self.contribution_account))
 
         msg += f'\nEstado del fondo:\n'
         msg += f'\* le falta pagar: `{abs(debts)}`\n'
@@ -1,14 +1,14 @@
 import logging
+from contextlib import contextmanager
 from datetime import datetime, timedelta, date, time
 from decimal import Decimal, InvalidOperation
 from typing import Optional
 
 import attr
-import requests as requests
-from peewee import DoesNotExist
+from peewee import Case, DoesNotExist
 
 from elram.repository.models import Event, User, AttendeeNotFound, Account, EventFinancialStatus, Transaction, \
-    Attendance
+    Attendance, Balance, MemberBalance, FinancialSnapshot, Tenant, database
 from elram.config import load_config
 
 CONFIG = load_config()
@@ -19,26 +19,92 @@ class CommandException(Exception):
     ...
 
 
+@attr.s
+class TenantService:
+
+    def get_tenant(self, name):
+        try:
+            return Tenant.get(Tenant.name == name)
+        except DoesNotExist:
+            raise CommandException(f'No conozco a la peña {name}')
+
+    def create_tenant(self, name, password, event_weekday, chat_id=None, first_event_code=1,
+                      first_event_host_nickname=None, with_records=True):
+        """
+        Create a peña group along with its accounts and its hidden host.
+
+        Tenants loaded from a bootstrap document get their accounts and users from it, so they are created without
+        records when `with_records` is false.
+        """
+        with database.atomic():
+            tenant = Tenant.create(
+                name=name,
+                chat_id=chat_id,
+                password=password,
+                event_weekday=event_weekday,
+                first_event_code=first_event_code,
+                first_event_host_nickname=first_event_host_nickname,
+            )
+            if with_records:
+                Account.insert_many([{'tenant': tenant.id, 'name': name} for name in Account.NAMES]).execute()
+                User.create(tenant=tenant, nickname=CONFIG['HIDDEN_USER_NICKNAME'], hidden=True)
+        Account.invalidate_registry()
+        logger.info('Tenant created', extra={'tenant': tenant.name, 'chat_id': tenant.chat_id})
+        return tenant
+
+
+@attr.s
 class UsersService:
+    tenant: Tenant = attr.ib()
 
     def find_user(self, nickname):
         nickname = nickname.title()
         try:
-            return User.get(nickname=nickname.title(), hidden=False)
+            return User.get(User.tenant == self.tenant, User.nickname == nickname, ~User.hidden)
         except DoesNotExist:
             raise CommandException(f'No conozco a ningún peñero con el nombre {nickname}')
 
+    ACCOUNT_NAMES = {
+        'Expenses': 'Gastos',
+        'Refunds': 'Reintegros',
+        'Social Fees': 'Cuotas',
+        'Contributions': 'Contribuciones',
+    }
+
+    def get_member_balance(self, nickname):
+        """
+        Return the outstanding balance of the user across all the events, and its `(account, balance)` breakdown.
+        """
+        user = self.find_user(nickname)
+        accounts = [(account, debit - credit) for account, debit, credit in MemberBalance.get_totals(user)]
+        return user, sum((balance for _, balance in accounts), 0), accounts
+
+    def display_member_balance(self, nickname):
+        user, total, accounts = self.get_member_balance(nickname)
+        total = round(total, 2)
+        msg = f'*Saldo de {user.nickname}*\n'
+        if not total:
+            msg += 'Está al día 👍\n'
+        elif total > 0:
+            msg += f'Tiene que pagar `{total}`\n'
+        else:
+            msg += f'Tiene que recibir `{abs(total)}`\n'
+        for account, balance in accounts:
+            msg += f'\* {self.ACCOUNT_NAMES.get(account.name, account.name)}: `{round(balance, 2)}`\n'
+        return msg
+
     def sign_in(self, telegram_user):
         try:
-            return User.get(User.is_staff, User.telegram_id == telegram_user.id)
+            return User.get(User.tenant == self.tenant, User.is_staff, User.telegram_id == telegram_user.id)
         except DoesNotExist:
             return
 
     def sign_up(self, telegram_user, password: str) -> Optional[User]:
-        if password != CONFIG['PASSWORD']:
+        if password != self.tenant.password:
             return
 
         user = User.create(
+            tenant=self.tenant,
             telegram_id=telegram_user.id,
             last_name=telegram_user.last_name,
             first_name=telegram_user.first_name,
@@ -49,6 +115,7 @@ class UsersService:
         logger.info(
             'User created',
             extra={
+                'tenant': self.tenant.name,
                 'telegram_id': user.telegram_id,
                 'first_name': user.first_name,
                 'last_name': user.last_name,
@@ -60,11 +127,14 @@ class UsersService:
 @attr.s
 class AttendanceService:
     event: Event = attr.ib()
-    users_service = attr.ib(factory=lambda: UsersService())
+    users_service = attr.ib(default=None)
     accountability_service = attr.ib(default=None)
 
     def __attrs_post_init__(self):
-        self.accountability_service = AccountabilityService(event=self.event)
+        if self.users_service is None:
+            self.users_service = UsersService(self.event.tenant)
+        if self.accountability_service is None:
+            self.accountability_service = AccountabilityService(event=self.event)
 
     def _add_attendance_for_user(self, user):
         attendee = self.event.add_attendee(user)
@@ -72,85 +142,62 @@ class AttendanceService:
         self.accountability_service.refresh_social_fees()
 
     def add_attendance(self, nickname):
-        user = self.users_service.find_user(nickname)
-        self._add_attendance_for_user(user)
+        with self.accountability_service.editing():
+            user = self.users_service.find_user(nickname)
+            self._add_attendance_for_user(user)
 
     def remove_attendance(self, nickname):
-        user = self.users_service.find_user(nickname)
-        if user == self.event.host:
-            raise CommandException(f'Primero decime quien organiza la peña si no va {user.nickname}')
-        self.event.remove_attendee(user)
-        self.accountability_service.refresh_social_fees()
+        with self.accountability_service.editing():
+            user = self.users_service.find_user(nickname)
+            if user == self.event.snapshot().host:
+                raise CommandException(f'Primero decime quien organiza la peña si no va {user.nickname}')
+            self.event.remove_attendee(user)
+            self.accountability_service.refresh_social_fees()
 
     def replace_host(self, nickname):
-        user = self.users_service.find_user(nickname)
-        if not self.event.is_attendee(user):
-            self._add_attendance_for_user(user)
-        self.event.replace_host(user)
+        with self.accountability_service.editing():
+            user = self.users_service.find_user(nickname)
+            if not self.event.snapshot().is_attendee(user):
+                self._add_attendance_for_user(user)
+            self.event.replace_host(user)
 
     def is_attendee(self, nickname):
         user = self.users_service.find_user(nickname)
-        return self.event.is_attendee(user)
+        return self.event.snapshot().is_attendee(user)
 
 
 @attr.s
 class EventService:
-    users_service = attr.ib(factory=lambda: UsersService())
-
-    def get_bootstrap_data(self, url):
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
+    tenant: Tenant = attr.ib()
+    # Rendered event messages by event id, along with the `updated` stamp they were rendered from.
+    _render_cache = attr.ib(factory=dict)
 
     def get_active_event(self):
         return Event.select()\
-            .where(Event.datetime >= datetime.now())\
+            .where((Event.tenant == self.tenant) & (Event.datetime >= datetime.now()))\
             .order_by(Event.datetime)\
             .first()
 
     def find_event_by_code(self, event_code: int):
         try:
-            return Event.get(Event.code == event_code)
+            return Event.get(Event.tenant == self.tenant, Event.code == event_code)
         except DoesNotExist:
             raise CommandException(f'No encontré la peña {event_code}')
 
-    @classmethod
-    def get_next_event_date(cls, offset=1):
+    def get_next_event_date(self, offset=1):
         today = date.today()
-        if today.weekday() == CONFIG['EVENT_WEEKDAY']:
+        if today.weekday() == self.tenant.event_weekday:
             day = today
         else:
-            day = today + timedelta(weeks=offset, days=CONFIG['EVENT_WEEKDAY'] - today.weekday())
+            day = today + timedelta(weeks=offset, days=self.tenant.event_weekday - today.weekday())
         return datetime.combine(day, time(23, 59))
 
-    def create_event(self, host, offset=1):
-        last_event = Event.get_last_event()
-        assert last_event is not None
-        next_code = last_event.code + 1
-        event = Event.create(
-            code=next_code,
-            datetime=self.get_next_event_date(offset)
-        )
-        accountability_service = AccountabilityService(event=event)
-        attendee = event.add_host(host)
-        accountability_service.create_social_fee_transaction(attendee)
-        logger.info(
-            'Event created',
-            extra={
-                'code': event.code,
-                'host': host.nickname,
-            }
-        )
-        hidden_host = User.get_hidden_host()
-        hidden_host_attendee = event.add_attendee(hidden_host)
-        accountability_service.create_social_fee_transaction(hidden_host_attendee)
-        return event
-
     def create_first_event(self):
         # FIXME: The first event should be created by `create_future_event` somehow
-        host = User.get(nickname=CONFIG['FIRST_EVENT_HOST_NICKNAME'])
+        host = User.get(User.tenant == self.tenant, User.nickname == self.tenant.first_event_host_nickname)
         event = Event.create(
-            code=CONFIG['FIRST_EVENT_CODE'],
+            tenant=self.tenant,
+            code=self.tenant.first_event_code,
             datetime=self.get_next_event_date()
         )
         accountability_service = AccountabilityService(event=event)
@@ -159,78 +206,176 @@ class EventService:
         logger.info(
             'Event created',
             extra={
+                'tenant': self.tenant.name,
                 'code': event.code,
                 'host': host.nickname,
             }
         )
-        hidden_host = User.get_hidden_host()
+        hidden_host = User.get_hidden_host(self.tenant)
         hidden_host_attendee = event.add_attendee(hidden_host)
         accountability_service.create_social_fee_transaction(hidden_host_attendee)
         return event
 
     def create_future_events(self):
-        future_hosts = list(User.get_future_hosts())
-        last_host = future_hosts[-1]
-        hosts = list(User.get_hosts())
-        index = hosts.index(last_host)
-        ordered_hosts = enumerate(hosts[index:] + hosts[:index])
-        for offset, host in ordered_hosts:
-            if host in future_hosts:
-                continue
-            self.create_event(host, offset=offset)
+        """
+        Create one event for each host that doesn't have a future event yet, following the hosts rotation.
+
+        The whole schedule is computed upfront and inserted with one query per table, inside a single transaction.
+        """
+        last_event = Event.get_last_event(self.tenant)
+        assert last_event is not None
+        hosts = list(User.get_hosts(self.tenant))
+        future_hosts = list(User.get_future_hosts(self.tenant))
+        if future_hosts:
+            last_host = future_hosts[-1]
+        else:
+            # Without future events, the rotation goes on after the host of the last one
+            last_host = User.select()\
+                .join(Attendance)\
+                .where((Attendance.event == last_event) & Attendance.is_host)\
+                .first()
+        index = hosts.index(last_host) if last_host in hosts else 0
+        scheduled_hosts = {host.id for host in future_hosts}
+        if last_host is not None:
+            scheduled_hosts.add(last_host.id)
+        schedule = [
+            (offset, host)
+            for offset, host in enumerate(hosts[index:] + hosts[:index])
+            if host.id not in scheduled_hosts
+        ]
+        if not schedule:
+            return []
+
+        hidden_host = User.get_hidden_host(self.tenant)
+        codes = [last_event.code + i for i in range(1, len(schedule) + 1)]
+        with database.atomic():
+            # Created rows are read back instead of using `RETURNING`, which not every backend supports
+            Event.insert_many([
+                {'tenant': self.tenant.id, 'code': code, 'datetime': self.get_next_event_date(offset)}
+                for code, (offset, _) in zip(codes, schedule)
+            ]).execute()
+            events = list(
+                Event.select(Event.id, Event.code)
+                .where((Event.tenant == self.tenant) & Event.code.in_(codes))
+                .order_by(Event.code)
+            )
+            Attendance.insert_many([
+                attendance
+                for event, (_, host) in zip(events, schedule)
+                for attendance in (
+                    {'event': event.id, 'attendee': host.id, 'is_host': True},
+                    {'event': event.id, 'attendee': hidden_host.id, 'is_host': False},
+                )
+            ]).execute()
+            attendances = list(
+                Attendance
+                .select(Attendance.id, Attendance.event)
+                .where(Attendance.event.in_([event.id for event in events]))
+            )
+            codes = {event.id: event.code for event in events}
+            Transaction.insert_many([
+                transaction
+                for attendance in attendances
+                for transaction in AccountabilityService.social_fee_transactions(
+                    self.tenant.id,
+                    attendance.id,
+                    codes[attendance.event_id],
+                )
+            ]).execute()
+            Balance.rebuild(Transaction.attendance.in_([attendance.id for attendance in attendances]))
+        for event, (_, host) in zip(events, schedule):
+            logger.info(
+                'Event created',
+                extra={
+                    'tenant': self.tenant.name,
+                    'code': event.code,
+                    'host': host.nickname,
+                }
+            )
+        return [event.id for event in events]
 
     def display_event(self, event):
-        financial_status = EventFinancialStatus(
+        cached = self._render_cache.get(event.id)
+        if cached is not None and cached[0] == event.updated:
+            return cached[1]
+        if event.is_closed:
+            msg = FinancialSnapshot.get_message(event.id)
+        else:
+            msg = self._render_event(event, event.snapshot())
+        self._render_cache[event.id] = (event.updated, msg)
+        return msg
+
+    @staticmethod
+    def _get_financial_status(event, snapshot):
+        return EventFinancialStatus(
             event=event,
-            cost_account=Account.get(name='Expenses'),
-            refund_account=Account.get(name='Refunds'),
-            social_fee_account=Account.get(name='Social Fees'),
-            contribution_account=Account.get(name='Contributions'),
+            snapshot=snapshot,
+            cost_account=Account.get_by_name(event.tenant_id, 'Expenses'),
+            refund_account=Account.get_by_name(event.tenant_id, 'Refunds'),
+            social_fee_account=Account.get_by_name(event.tenant_id, 'Social Fees'),
+            contribution_account=Account.get_by_name(event.tenant_id, 'Contributions'),
         )
+
+    def _render_event(self, event, snapshot, financial_status=None):
+        if financial_status is None:
+            financial_status = self._get_financial_status(event, snapshot)
         msg = (
             f'*Peña \#{event.code} \- {event.datetime_display}*\n'
-            f'La organiza {event.host}\n'
+            f'La organiza {snapshot.host}\n'
         )
-        msg += event.display_attendees()
+        msg += snapshot.display_attendees()
         msg += '\n'
         if financial_status.total_cost > 0:
             msg += financial_status.display()
             msg += '\n'
         return msg
 
+    def get_closable_events(self):
+        return Event.select()\
+            .where((Event.tenant == self.tenant) & (Event.datetime < datetime.now()) & (Event.status != Event.CLOSED))\
+            .order_by(Event.code)
+
+    def close_event(self, event):
+        """
+        Close the event, freezing its financial status and rendered message so it's never computed again.
+
+        Closed events are rendered from the frozen message and can't be changed anymore.
+        """
+        with database.atomic():
+            # Locked so no write to the event is committed after its snapshot is frozen
+            if Event.get_status(event.id, for_update=True) == Event.CLOSED:
+                raise CommandException(f'La peña {event.code} ya está cerrada')
+            snapshot = event.snapshot()
+            financial_status = self._get_financial_status(event, snapshot)
+            message = self._render_event(event, snapshot, financial_status)
+            message += 'La peña está cerrada 🔒\n'
+            FinancialSnapshot.freeze(financial_status, message)
+            Event.update(status=Event.CLOSED, updated=datetime.now()).where(Event.id == event.id).execute()
+        logger.info('Event closed', extra={'code': event.code})
+        return event.refresh()
 
 
 @attr.s
 class AccountabilityService:
     event: Event = attr.ib()
-    _EXPENSE = None
-    _REFUND = None
-    _CONTRIBUTION = None
-    _SOCIAL_FEE = None
+    # `None` when social fees are refreshed right away, otherwise whether a deferred refresh is pending
+    _pending_refresh = attr.ib(init=False, default=None)
 
     @property
     def EXPENSE(self):
-        if self._EXPENSE is None:
-            self._EXPENSE = Account.get(name='Expenses')
-        return self._EXPENSE
+        return Account.get_by_name(self.event.tenant_id, 'Expenses')
 
     @property
     def REFUND(self):
-        if self._REFUND is None:
-            self._REFUND = Account.get(name='Refunds')
-        return self._REFUND
+        return Account.get_by_name(self.event.tenant_id, 'Refunds')
 
     @property
     def CONTRIBUTION(self):
-        if self._CONTRIBUTION is None:
-            self._CONTRIBUTION = Account.get(name='Contributions')
-        return self._CONTRIBUTION
+        return Account.get_by_name(self.event.tenant_id, 'Contributions')
 
     @property
     def SOCIAL_FEE(self):
-        if self._SOCIAL_FEE is None:
-            self._SOCIAL_FEE = Account.get(name='Social Fees')
-        return self._SOCIAL_FEE
+        return Account.get_by_name(self.event.tenant_id, 'Social Fees')
 
     @staticmethod
     def _get_amount(str_value):
@@ -239,28 +384,73 @@ class AccountabilityService:
         except InvalidOperation:
             raise CommandException(f'No entiendo que cantidad de plata es esta: {str_value}')
 
-    def _find_attendee(self, nickname):
+    @staticmethod
+    def _find_attendee(snapshot, nickname):
         try:
-            attendee = self.event.find_attendee(nickname)
+            attendee = snapshot.find_attendee(nickname)
         except AttendeeNotFound as ex:
             raise CommandException(str(ex))
         return attendee
 
-    def create_social_fee_transaction(self, attendee):
-        Transaction.create(
-            attendance=attendee,
-            account=self.SOCIAL_FEE,
-            description=f'Cuota peña #{self.event.code}',
-        )
-        Transaction.create(
-            attendance=attendee,
-            account=self.CONTRIBUTION,
-            description=f'Contribución peña #{self.event.code}',
-        )
+    @classmethod
+    def social_fee_transactions(cls, tenant_id, attendance_id, event_code):
+        """
+        Rows of the social fee and contribution transactions every attendance starts with.
+        """
+        return [
+            {
+                'tenant': tenant_id,
+                'attendance': attendance_id,
+                'account': Account.get_by_name(tenant_id, 'Social Fees').id,
+                'description': f'Cuota peña #{event_code}',
+            },
+            {
+                'tenant': tenant_id,
+                'attendance': attendance_id,
+                'account': Account.get_by_name(tenant_id, 'Contributions').id,
+                'description': f'Contribución peña #{event_code}',
+            },
+        ]
+
+    @contextmanager
+    def editing(self):
+        """
+        Run the writes of the block in a transaction that keeps the event locked.
+
+        Fails if the event was closed, since the frozen snapshot would no longer match its transactions. The status is
+        read under the same lock `EventService.close_event` takes, so the event can't be closed before the writes are
+        committed.
+        """
+        with database.atomic():
+            if Event.get_status(self.event.id, for_update=True) == Event.CLOSED:
+                raise CommandException(f'La peña {self.event.code} está cerrada, ya no se puede cambiar')
+            yield
 
-    def refresh_social_fees(self):
+    def create_social_fee_transaction(self, attendee):
+        for transaction in self.social_fee_transactions(self.event.tenant_id, attendee.id, self.event.code):
+            Transaction.create(**transaction)
+
+    @contextmanager
+    def deferred_refresh(self):
+        """
+        Refresh the social fees only once, when the block finishes, no matter how many writes it makes.
+        """
+        self._pending_refresh = False
+        try:
+            yield
+            pending = self._pending_refresh
+        finally:
+            self._pending_refresh = None
+        if pending:
+            self.refresh_social_fees()
+
+    def refresh_social_fees(self, snapshot=None):
+        if self._pending_refresh is not None:
+            self._pending_refresh = True
+            return
         financial_status = EventFinancialStatus(
             event=self.event,
+            snapshot=snapshot,
             cost_account=self.EXPENSE,
             refund_account=self.REFUND,
             social_fee_account=self.SOCIAL_FEE,
@@ -272,58 +462,73 @@ class AccountabilityService:
             "Setting social fee",
             extra={'cost': cost, 'contribution': contribution, 'event': self.event}
         )
-        for attendee in self.event.effective_attendees:
-            Transaction.update(debit=financial_status.cost_per_capita) \
-                .where((Transaction.attendance == attendee) & (Transaction.account == self.SOCIAL_FEE))\
+        hidden_host = financial_status.hidden_host
+        attendances = [a.id for a in financial_status.effective_attendances] + [hidden_host.id]
+        is_hidden_host = Transaction.attendance == hidden_host.id
+        with database.atomic():
+            # The hidden host collects what every effective attendee owes, so both sides of each account are
+            # rewritten in a single statement.
+            Transaction.update(
+                debit=Case(None, [(is_hidden_host, Transaction.debit)], financial_status.cost_per_capita),
+                credit=Case(None, [(is_hidden_host, financial_status.total_cost)], Transaction.credit),
+            ) \
+                .where(Transaction.attendance.in_(attendances) & (Transaction.account == self.SOCIAL_FEE))\
                 .execute()
-            Transaction.update(debit=financial_status.per_capita_contribution) \
-                .where((Transaction.attendance == attendee) & (Transaction.account == self.CONTRIBUTION))\
+            Transaction.update(
+                debit=Case(None, [(is_hidden_host, Transaction.debit)], financial_status.per_capita_contribution),
+                credit=Case(None, [(is_hidden_host, financial_status.total_contribution)], Transaction.credit),
+            ) \
+                .where(Transaction.attendance.in_(attendances) & (Transaction.account == self.CONTRIBUTION))\
                 .execute()
-        hidden_host = self.event.hidden_host
-        Transaction.update(credit=financial_status.total_cost) \
-            .where((Transaction.attendance == hidden_host) & (Transaction.account == self.SOCIAL_FEE)) \
-            .execute()
-        Transaction.update(credit=financial_status.total_contribution) \
-            .where((Transaction.attendance == hidden_host) & (Transaction.account == self.CONTRIBUTION)) \
-            .execute()
+            Balance.rebuild(
+                Transaction.attendance.in_(attendances)
+                & Transaction.account.in_([self.SOCIAL_FEE, self.CONTRIBUTION])
+            )
+            Event.touch(self.event.id)
 
     def add_expense(self, nickname: str, amount: str, description: str = None):
-        attendee = self._find_attendee(nickname.title())
-        amount = self._get_amount(amount)
-        logger.info(
-            "Adding expense",
-            extra={'attendee': attendee, 'amount': amount, 'description': description, 'event': self.event}
-        )
-        attendee.add_credit(amount, self.EXPENSE, description=description)
-        self.event.hidden_host.add_debit(amount, self.EXPENSE, description=description)
-        self.refresh_social_fees()
+        with self.editing():
+            snapshot = self.event.snapshot()
+            attendee = self._find_attendee(snapshot, nickname.title())
+            amount = self._get_amount(amount)
+            logger.info(
+                "Adding expense",
+                extra={'attendee': attendee, 'amount': amount, 'description': description, 'event': self.event}
+            )
+            attendee.add_credit(amount, self.EXPENSE, description=description)
+            snapshot.hidden_host.add_debit(amount, self.EXPENSE, description=description)
+            self.refresh_social_fees(snapshot)
 
     def add_payment(self, nickname: str, amount: str, to_nickname: str = None):
-        payment_to_found = to_nickname is None
-
-        attendee = self._find_attendee(nickname.title())
-        to_attendee = None
-        if not payment_to_found:
-            to_attendee = self._find_attendee(to_nickname.title())
-        hidden_host = self.event.hidden_host
-
-        amount = self._get_amount(amount)
-        logger.info(
-            "Adding payment",
-            extra={'from': attendee, 'to': to_attendee, 'amount': amount, 'event': self.event}
-        )
-        attendee.add_credit(amount, self.REFUND)
-        hidden_host.add_debit(amount, self.REFUND)
-        if not payment_to_found:
-            to_attendee.add_debit(amount, self.REFUND)
-            hidden_host.add_credit(amount, self.REFUND)
+        with self.editing():
+            payment_to_found = to_nickname is None
+
+            snapshot = self.event.snapshot()
+            attendee = self._find_attendee(snapshot, nickname.title())
+            to_attendee = None
+            if not payment_to_found:
+                to_attendee = self._find_attendee(snapshot, to_nickname.title())
+            hidden_host = snapshot.hidden_host
+
+            amount = self._get_amount(amount)
+            logger.info(
+                "Adding payment",
+                extra={'from': attendee, 'to': to_attendee, 'amount': amount, 'event': self.event}
+            )
+            attendee.add_credit(amount, self.REFUND)
+            hidden_host.add_debit(amount, self.REFUND)
+            if not payment_to_found:
+                to_attendee.add_debit(amount, self.REFUND)
+                hidden_host.add_credit(amount, self.REFUND)
 
     def add_refound(self, nickname: str, amount: str):
-        attendee = self._find_attendee(nickname.title())
-        amount = self._get_amount(amount)
-        logger.info(
-            "Adding refound",
-            extra={'attendee': attendee, 'amount': amount,}
-        )
-        attendee.add_debit(amount, self.REFUND)
-        self.event.hidden_host.add_credit(amount, self.REFUND)
+        with self.editing():
+            snapshot = self.event.snapshot()
+            attendee = self._find_attendee(snapshot, nickname.title())
+            amount = self._get_amount(amount)
+            logger.info(
+                "Adding refound",
+                extra={'attendee': attendee, 'amount': amount,}
+            )
+            attendee.add_debit(amount, self.REFUND)
+            snapshot.hidden_host.add_credit(amount, self.REFUND)
@@ -0,0 +1,64 @@
+import io
+import json
+from decimal import Decimal
+
+import pytest
+
+from elram.repository.commands import MODELS, populate_db
+from elram.repository.models import Attendance, Balance, Transaction, User, Account
+from elram.repository.services import TenantService
+
+DOCUMENT = {
+    'users': [
+        {'id': 7, 'nickname': 'Juan', 'is_host': True},
+        {'id': 8, 'nickname': 'Fondo', 'hidden': True},
+    ],
+    'accounts': [{'id': i, 'name': name} for i, name in enumerate(Account.NAMES, 11)],
+    'events': [{'id': 21, 'code': 1, 'datetime': '2021-01-01 23:59:00'}],
+    'attendances': [
+        {'id': 31, 'event': 21, 'attendee': 7, 'is_host': True},
+        {'id': 32, 'event_id': 21, 'attendee_id': 8},
+    ],
+    'transactions': [{'attendance': 31, 'account': 11, 'debit': 0, 'credit': 100}],
+}
+
+
+def load(document, tenant):
+    populate_db(io.BytesIO(json.dumps(document).encode()), tenant)
+
+
+@pytest.fixture
+def tenants(db):
+    db.create_tables(MODELS)
+    service = TenantService()
+    return [service.create_tenant(name, password='x', event_weekday=4, with_records=False) for name in ('a', 'b')]
+
+
+def test_records_refer_to_their_tenant(tenants):
+    for tenant in tenants:
+        load(DOCUMENT, tenant)
+
+    for tenant in tenants:
+        attendances = Attendance.select().join(User).where(User.tenant == tenant)
+        assert len(attendances) == 2
+        assert all(attendance.event.tenant_id == tenant.id for attendance in attendances)
+        transaction = Transaction.get(Transaction.tenant == tenant)
+        assert transaction.attendance.attendee.tenant_id == tenant.id
+        assert transaction.account.tenant_id == tenant.id
+        assert Balance.get(Balance.attendance == transaction.attendance).credit == Decimal(100)
+
+
+def test_ids_are_not_taken_from_the_document(tenants):
+    # Records inserted with explicit ids would leave the Postgres sequences behind
+    load(DOCUMENT, tenants[0])
+
+    for section, model_class in (('users', User), ('attendances', Attendance)):
+        document_ids = {record['id'] for record in DOCUMENT[section]}
+        assert not document_ids & {row.id for row in model_class.select(model_class.id)}
+
+
+def test_reject_references_outside_the_document(tenants):
+    document = dict(DOCUMENT, attendances=[{'id': 31, 'event': 21, 'attendee': 9}])
+
+    with pytest.raises(ValueError):
+        load(document, tenants[0])
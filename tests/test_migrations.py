@@ -0,0 +1,72 @@
+from decimal import Decimal
+
+from elram.repository.commands import MIGRATIONS, migrate_db, reconcile_balances
+from elram.repository.models import Balance, MemberBalance, SchemaMigration, Tenant, User, Event, Account, Transaction
+
+# Schema of the databases created before the migrations existed
+BASELINE_SCHEMA = (
+    'CREATE TABLE "user" (id INTEGER PRIMARY KEY, updated DATETIME NOT NULL, created DATETIME NOT NULL, '
+    'telegram_id INTEGER, first_name VARCHAR(255), last_name VARCHAR(255), nickname VARCHAR(255) NOT NULL, '
+    'is_staff INTEGER NOT NULL, hidden INTEGER NOT NULL, is_host INTEGER NOT NULL)',
+    'CREATE UNIQUE INDEX user_telegram_id ON "user" (telegram_id)',
+    'CREATE UNIQUE INDEX user_nickname ON "user" (nickname)',
+    'CREATE TABLE event (id INTEGER PRIMARY KEY, updated DATETIME NOT NULL, created DATETIME NOT NULL, '
+    'datetime DATETIME NOT NULL, code INTEGER NOT NULL)',
+    'CREATE TABLE account (id INTEGER PRIMARY KEY, updated DATETIME NOT NULL, created DATETIME NOT NULL, '
+    'name VARCHAR(255) NOT NULL)',
+    'CREATE UNIQUE INDEX account_name ON account (name)',
+    'CREATE TABLE attendance (id INTEGER PRIMARY KEY, updated DATETIME NOT NULL, created DATETIME NOT NULL, '
+    'attendee_id INTEGER NOT NULL REFERENCES "user" (id), event_id INTEGER NOT NULL REFERENCES event (id), '
+    'is_host INTEGER NOT NULL)',
+    'CREATE UNIQUE INDEX attendance_attendee_id_event_id ON attendance (attendee_id, event_id)',
+    'CREATE TABLE "transaction" (id INTEGER PRIMARY KEY, updated DATETIME NOT NULL, created DATETIME NOT NULL, '
+    'attendance_id INTEGER NOT NULL REFERENCES attendance (id) ON DELETE CASCADE, '
+    'account_id INTEGER NOT NULL REFERENCES account (id), description VARCHAR(255) NOT NULL, '
+    'debit DECIMAL(10, 5) NOT NULL, credit DECIMAL(10, 5) NOT NULL)',
+)
+NOW = '2021-01-01 00:00:00'
+
+
+def create_baseline_database(db):
+    for statement in BASELINE_SCHEMA:
+        db.execute_sql(statement)
+    db.execute_sql(
+        f'INSERT INTO "user" VALUES (1, "{NOW}", "{NOW}", 10, "Juan", "Perez", "Juan", 1, 0, 1), '
+        f'(2, "{NOW}", "{NOW}", NULL, NULL, NULL, "Fondo", 0, 1, 0)'
+    )
+    db.execute_sql(f'INSERT INTO event VALUES (1, "{NOW}", "{NOW}", "{NOW}", 1)')
+    db.execute_sql(
+        'INSERT INTO account VALUES '
+        + ', '.join(f'({i}, "{NOW}", "{NOW}", "{name}")' for i, name in enumerate(Account.NAMES, 1))
+    )
+    db.execute_sql(f'INSERT INTO attendance VALUES (1, "{NOW}", "{NOW}", 1, 1, 1), (2, "{NOW}", "{NOW}", 2, 1, 0)')
+    db.execute_sql(
+        f'INSERT INTO "transaction" VALUES (1, "{NOW}", "{NOW}", 1, 1, "", 0, 100), '
+        f'(2, "{NOW}", "{NOW}", 1, 3, "", 50, 0), (3, "{NOW}", "{NOW}", 1, 3, "", 0, 20)'
+    )
+
+
+def test_migrate_baseline_database(db):
+    create_baseline_database(db)
+
+    assert migrate_db() == [version for version, _, _ in MIGRATIONS]
+
+    assert SchemaMigration.get_version() == MIGRATIONS[-1][0]
+    tenant = Tenant.get()
+    assert tenant.name == Tenant.DEFAULT_NAME
+    for model in (User, Event, Account, Transaction):
+        assert not model.select().where(model.tenant != tenant).exists()
+    social_fees = Balance.get(Balance.attendance == 1, Balance.account == 3)
+    assert (social_fees.debit, social_fees.credit) == (Decimal(50), Decimal(20))
+    member_social_fees = MemberBalance.get(MemberBalance.user == 1, MemberBalance.account == 3)
+    assert (member_social_fees.debit, member_social_fees.credit) == (Decimal(50), Decimal(20))
+    assert reconcile_balances() == []
+
+
+def test_migrations_skip_applied_changes(db):
+    create_baseline_database(db)
+    migrate_db()
+    SchemaMigration.delete().execute()
+
+    assert migrate_db() == [version for version, _, _ in MIGRATIONS]
+    assert reconcile_balances() == []